@@ -17,8 +17,8 @@ described above, and functions that develops
 different mass flows based on different scenarios
 of DRS return rates.
 
-Most functions automatically output the resulting 
-dataframe in a CSV file.
+Most functions output the resulting dataframe
+to an output sink, which can save it in a CSV file.
 
 Other supplementary data are from the following:
 The Office of National Statistics - 
@@ -56,270 +56,1626 @@ Then, any function defined this module can be executed
 in the iPython notebook.
 
 For example, to execute the function that displays the
-mass flow baseline and automatically saves it in an .csv file, 
+mass flow baseline and saves it in an .csv file, 
 execute the following in a command box:
 
+massflow_baseline.output_sink = massflow_baseline.csv_sink
 massflow_baseline.get_massflow_baseline()
 
+Without the first line, nothing is written to disk and the latest
+table of each kind is kept in massflow_baseline.outputs instead.
+
 Note: The first "massflow_baseline" is the name of this module
 The ".get_massflow_baseline()" is calling the function in the module
 
+The raw data spreadsheet is only parsed once. If pyarrow is installed, a copy of
+the filtered raw data is saved next to it as a .feather file, which is read instead
+of the spreadsheet from then on (until the spreadsheet changes).
+
+Each get_* function is a stage in a dependency graph, and within one call every
+intermediate table is computed only once. To see which stages a function uses:
+
+print(massflow_baseline.explain('get_massflow_baseline'))
+
+The results of get_massflow_baseline() and the get_*_drs functions are also
+saved in data_dir/cache, so repeating a call with the same options is fast,
+even after restarting the notebook. massflow_baseline.clear_result_cache() empties it.
+
+On a machine with several cores, the streams of the baseline can be computed at the
+same time, e.g. in 4 worker processes:
+
+massflow_baseline.max_workers = 4
+
+The baseline sums the tonnages of every local authority. They are kept, by stream
+and DRS material, in:
+
+cube = massflow_baseline.get_massflow_cube()
+massflow_baseline.get_cube_baseline(cube, ['Cardiff Council','Newport City Council'])
+
+The baseline is for April 2014 to March 2015 (the Periods in excluded_periods are left out).
+For each quarter of it, with every table having one row for each local authority and quarter:
+
+with massflow_baseline.quarterly():
+    baseline = massflow_baseline.get_massflow_baseline()
+
+For every rolling year (4 consecutive quarters) in the spreadsheet instead:
+
+massflow_baseline.get_rolling_baselines()
+
+To re-evaluate the baseline many times with other composition rates, or corrected
+tonnages of some local authorities, compile it once:
+
+compiled = massflow_baseline.compile_baseline()
+massflow_baseline.evaluate_compiled_baseline(compiled, {'hhkerb_rec_reject': 0.85})
+
+Which composition rates (and baseline_constants) drive the remains in the environment,
+from Sobol indices or Morris screening with every parameter within +-10% of its value:
+
+massflow_baseline.get_massflow_sensitivity('Sobol')
+massflow_baseline.get_massflow_sensitivity('Morris')
+
+To adjust some composition rates, within bounds, so that the remains in the environment
+match a target (in thousand tonnes), e.g. from a litter survey:
+
+rates, baseline, fit = massflow_baseline.calibrate_rates({'Total': 20.0},
+                                                         {'lit_res_sweeping': (0.3, 0.7)})
+print(fit['targets'])
+massflow_baseline.composition_rates.update(rates)
+
+A warning is given when a target cannot be met within the bounds.
+
+The total weight placed on the market comes from the inputs in market_parameters.
+For the baseline at every combination of some of them (the streams are computed once):
+
+massflow_baseline.get_market_sweep({'ave_pet_size': np.arange(0.5, 1.55, 0.05),
+                                    'ferrous_share': [0.2, 0.22, 0.25]})
+
+To see where the time goes in a call, and which stages were found in a cache:
+
+with massflow_baseline.profile_stages() as trace:
+    massflow_baseline.get_massflow_baseline()
+massflow_baseline.get_stage_summary(trace)
+
 For more information on the functions, please read the comments attached.
 """
 
 import numpy as np 
 import pandas as pd 
+import os
 import os.path as op  
 import datetime as dt 
 import time 
+import threading
+import hashlib
+import glob
+import copy
+import contextlib
+import functools
+import inspect
+import itertools
+import multiprocessing
+import collections
+import pickle
+import zlib
+import json
+import warnings
+import re
+import tempfile
+try:
+    import pyarrow.feather as feather
+except ImportError:
+    feather = None
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+try:
+    import openpyxl
+except ImportError:
+    openpyxl = None
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+try:
+    import scipy.sparse as sparse
+    import scipy.optimize as optimize
+except ImportError:
+    sparse = optimize = None
 pd.set_option('display.max_columns', None)
 pd.set_option('display.max_rows', None)
 data_dir = op.join('data') 
+raw_file = 'raw_jan14-sep15.xls'
+#Quarters of the spreadsheet left out of the baseline (April 2014 to March 2015)
+excluded_periods = ['Jan 14 - Mar 14']
+#Keep a columnar copy of the filtered raw data next to the spreadsheet (needs pyarrow)
+use_sidecar = True
+#QuestionNumbers used by the stages. For a large export, set raw_questions = pipeline_questions
+#to keep only the rows of these questions when reading it (None keeps every question),
+#then call clear_cache()
+pipeline_questions = ['Q001','Q010','Q011','Q016','Q017','Q023']
+raw_questions = None
+#Number of worker processes computing the streams of the baseline at the same time
+#(see _run_stream_groups()). None computes them one after the other.
+max_workers = None
 
 """ 
 Import raw data
 
 """
 
+#The parsed WasteDataFlow extract is kept for the life of the process.
+#'key' is (path, size, mtime) of the workbook it was parsed from, and 'version'
+#goes up every time the workbook is re-parsed.
+#'blocks' is the partition index of the raw data built by _build_blocks(), and
+#'memo' holds tables derived from this version of the raw data (see _memoize())
+#'periods' maps each Period changed by update_period() to the version it was changed in,
+#'partials' holds tables derived from the rows of one Period (see _pivot_periods()), and
+#'updates' has a hash of the rows of each update_period() since the workbook was parsed
+_data_cache = {'key': None, 'raw': None, 'blocks': None, 'memo': {}, 'version': 0,
+               'periods': {}, 'partials': {}, 'updates': []}
+_data_lock = threading.RLock()
+
+_irrelevant_columns = ['CollateText','RowOrder','ColOrder','RowIdent',
+                       'ColIdent','CollateID','columngroup']
+
+#Text columns held as categoricals in the cache, i.e. integer codes into one dictionary
+#of distinct strings per column, instead of the same long strings repeated on every row
+_coded_columns = ['Authority','Period','QuestionNumber','QuText','RowText',
+                  'ColText','MaterialGroup']
+
+def _read_chunks(path, chunksize):
+    """
+    Input: Path to a .csv file or .xlsx spreadsheet exported from WasteDataFlow
+    Output: Iterator over dataframes of at most chunksize rows of it (of the NotQ100 sheet),
+    so that the whole export is never in memory at once
+    """
+    if path.lower().endswith('.csv'):
+        for chunk in pd.read_csv(path, header= 1, chunksize=chunksize):
+            yield chunk
+        return
+    if openpyxl is None:
+        raise ImportError('openpyxl is required to read .xlsx files in chunks')
+    book = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    try:
+        rows = book['NotQ100'].iter_rows()
+        #Same layout as the .xls, the column names are in the second row
+        next(rows)
+        columns = [cell.value for cell in next(rows)]
+        chunk = []
+        for row in rows:
+            chunk.append([cell.value for cell in row])
+            if len(chunk) == chunksize:
+                yield pd.DataFrame(chunk, columns=columns)
+                chunk = []
+        if chunk:
+            yield pd.DataFrame(chunk, columns=columns)
+    finally:
+        book.close()
+
+def read_export(path, questions = None, chunksize = 100000):
+    """
+    Input: Path to a spreadsheet (.xls or .xlsx) or .csv file exported from WasteDataFlow,
+    and optionally the QuestionNumbers to keep, e.g. pipeline_questions (None keeps every question)
+    Output: Raw data of every Period in it, excluding some irrelevant columns.
+    .csv and .xlsx files are read chunksize rows at a time, and only the rows of the wanted
+    questions are kept from each chunk, so memory use follows the rows kept rather than the
+    size of the export. .xls files can only be read whole.
+    """
+    if op.splitext(path)[1].lower() in ('.csv', '.xlsx'):
+        frames = []
+        for chunk in _read_chunks(path, chunksize):
+            chunk = chunk.drop(_irrelevant_columns, axis=1)
+            if questions is not None:
+                chunk = chunk[chunk['QuestionNumber'].isin(questions)]
+            frames.append(chunk)
+        return pd.concat(frames, ignore_index=True)
+    raw = pd.read_excel(path, sheetname='NotQ100', header= 1)
+    raw = raw.drop(_irrelevant_columns, axis=1)
+    if questions is not None:
+        raw = raw[raw['QuestionNumber'].isin(questions)]
+    return raw
+
+def _source_key(path):
+    stat = os.stat(path)
+    return (op.abspath(path), stat.st_size, stat.st_mtime)
+
+def _file_hash(path):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+def _sidecar_digest(path):
+    digest = _file_hash(path)
+    if raw_questions is not None:
+        #A sidecar of some of the questions only
+        digest = hashlib.sha1((digest + ' ' + ' '.join(sorted(raw_questions))).encode('utf-8')).hexdigest()
+    return digest
+
+def _sidecar_variant():
+    #Which questions a sidecar holds: all of them, or those of raw_questions
+    if raw_questions is None:
+        return 'all'
+    return 'q' + hashlib.sha1(' '.join(sorted(raw_questions)).encode('utf-8')).hexdigest()[:8]
+
+def _sidecar_path(path, digest):
+    #e.g. data/raw_jan14-sep15.all.3f2a9c0d51e4b7a8.v3.feather
+    #(v3 sidecars are named by variant, v2 ones hold every Period, earlier ones left out excluded_periods)
+    stem = op.splitext(path)[0]
+    return stem + '.' + _sidecar_variant() + '.' + digest[:16] + '.v3.feather'
+
+_replace_file = getattr(os, 'replace', os.rename)
+
+def _write_sidecar(raw, path, digest):
+    """
+    Input: Raw data from read_export() and the hash of the spreadsheet it came from
+    Output: Path of the uncompressed Feather file holding the same data.
+    Sidecars of the same variant (see _sidecar_variant()) left over from older versions of the
+    spreadsheet are removed, as are those named before variants, which are never read again.
+    """
+    sidecar = _sidecar_path(path, digest)
+    #A temporary file of its own, so that processes writing the same sidecar do not mix their writes
+    handle, tmp = tempfile.mkstemp(prefix=op.basename(sidecar) + '.', suffix='.tmp',
+                                   dir=op.dirname(op.abspath(sidecar)))
+    os.close(handle)
+    try:
+        #Uncompressed, so that numeric columns can be memory-mapped without a copy
+        feather.write_feather(raw, tmp, compression='uncompressed')
+        _replace_file(tmp, sidecar)
+    finally:
+        if op.exists(tmp):
+            os.remove(tmp)
+    
+    prefix = op.splitext(path)[0] + '.'
+    stale = re.compile(r'(%s\.[0-9a-f]{16}\.v3|[0-9a-f]{16}(\.v2)?)\.feather$' % re.escape(_sidecar_variant()))
+    for old in glob.glob(prefix + '*.feather'):
+        if old != sidecar and stale.match(old[len(prefix):]):
+            try:
+                os.remove(old)
+            except OSError:
+                #e.g. memory-mapped by another process on Windows
+                pass
+    return sidecar
+
+def _read_sidecar(sidecar):
+    return feather.read_table(sidecar, memory_map=True).to_pandas()
+
+def _parse_raw(path):
+    """
+    Input: Path to the Excel spreadsheet exported from WasteDataFlow
+    Output: Raw data, read from the Feather sidecar if there is one for this exact
+    spreadsheet (same hash), otherwise parsed from Excel and written to a new sidecar.
+    The text columns are coded (see _encode()), and stored as dictionaries in the sidecar.
+    """
+    if not use_sidecar or feather is None:
+        return _encode(read_export(path, questions=raw_questions))
+    digest = _sidecar_digest(path)
+    sidecar = _sidecar_path(path, digest)
+    if op.exists(sidecar):
+        #Sidecars written before the text columns were coded hold plain strings
+        return _encode(_read_sidecar(sidecar))
+    raw = _encode(read_export(path, questions=raw_questions))
+    try:
+        _write_sidecar(raw, path, digest)
+    except (IOError, OSError, ValueError, TypeError):
+        #Not fatal, e.g. read-only data directory or columns of mixed types
+        pass
+    return raw
+
+def _encode(raw):
+    """
+    Input: Raw data
+    Output: The same data with the text columns of _coded_columns as categoricals
+    """
+    columns = collections.OrderedDict()
+    for col in raw.columns:
+        if col in _coded_columns and raw[col].dtype == object:
+            columns[col] = raw[col].astype('category')
+        else:
+            columns[col] = raw[col]
+    return pd.DataFrame(columns, index=raw.index, columns=raw.columns)
+
+def _decode(rows):
+    """
+    Input: Rows of the cached raw data
+    Output: The same rows with the categorical columns back as plain strings, so that
+    groupby() and unstack() in the stages only see the values that are actually there
+    """
+    columns = collections.OrderedDict()
+    for col in rows.columns:
+        if str(rows[col].dtype) == 'category':
+            columns[col] = rows[col].astype(object)
+        else:
+            columns[col] = rows[col]
+    return pd.DataFrame(columns, index=rows.index, columns=rows.columns)
+
+def _build_blocks(raw):
+    """
+    Input: Raw data
+    Output: The raw data reordered by (QuestionNumber, ColText), and a dict mapping
+    each (QuestionNumber, ColText) pair, and each QuestionNumber on its own,
+    to the (start, stop) positions of the contiguous block of rows holding it.
+    Rows keep their original order (and index labels) within each block.
+    """
+    qu_codes, qu_names = pd.factorize(raw['QuestionNumber'], sort=True)
+    col_codes, col_names = pd.factorize(raw['ColText'], sort=True)
+    order = np.lexsort((col_codes, qu_codes))
+    raw = raw.iloc[order]
+    qu_codes = qu_codes[order]
+    col_codes = col_codes[order]
+    #Positions where either key changes are the block boundaries
+    breaks = np.flatnonzero((np.diff(qu_codes) != 0) | (np.diff(col_codes) != 0)) + 1
+    starts = np.concatenate([[0], breaks])
+    stops = np.concatenate([breaks, [len(raw)]])
+    blocks = {}
+    if len(raw) == 0:
+        return raw, blocks
+    for start, stop in zip(starts, stops):
+        qu, col = qu_codes[start], col_codes[start]
+        #Rows with a missing QuestionNumber or ColText are not indexed
+        if qu < 0:
+            continue
+        qu_start, qu_stop = blocks.get(qu_names[qu], (start, stop))
+        blocks[qu_names[qu]] = (min(qu_start, start), max(qu_stop, stop))
+        if col >= 0:
+            blocks[(qu_names[qu], col_names[col])] = (start, stop)
+    return raw, blocks
+
+def _load_raw():
+    """
+    Input: Excel spreadsheet exported from WasteDataFlow
+    Output: The cached raw data, re-parsed only if the path, size or mtime
+    of the spreadsheet has changed since it was last read
+    """
+    path = op.join(data_dir, raw_file)
+    key = _source_key(path)
+    with _data_lock:
+        if _data_cache['key'] != key:
+            raw, blocks = _build_blocks(_parse_raw(path))
+            _data_cache['raw'] = raw
+            _data_cache['blocks'] = blocks
+            _data_cache['memo'] = {}
+            _data_cache['periods'] = {}
+            _data_cache['partials'] = {}
+            _data_cache['updates'] = []
+            _data_cache['key'] = key
+            _data_cache['version'] += 1
+        return _data_cache['raw']
+
+def update_period(rows):
+    """
+    Input: Rows of the raw data for one or more Periods, e.g. from the export of a new
+    WasteDataFlow quarter:
+
+    new = massflow_baseline.read_export(op.join('data', 'raw_oct15-dec15.xls'))
+    massflow_baseline.update_period(new)
+
+    Output: None. The rows replace the rows of the same Periods in the cached raw data
+    (or are added to it). Tables derived from the other Periods are not recomputed.
+    The update lasts until the spreadsheet itself changes or clear_cache() is called.
+    """
+    text = rows.to_csv(index=False)
+    if not isinstance(text, bytes):
+        text = text.encode('utf-8')
+    with _data_lock:
+        raw = _load_raw()
+        rows = rows[list(raw.columns)].copy()
+        #New rows go after the rows of the spreadsheet in the original order (see get_data())
+        start = raw.index.max() + 1 if len(raw) else 0
+        rows.index = range(start, start + len(rows))
+        periods = rows['Period'].dropna().unique()
+        #Re-coded, as the dictionaries of the new rows differ from those of the cache
+        raw = _encode(pd.concat([raw[~raw['Period'].isin(periods)], rows]))
+        _data_cache['raw'], _data_cache['blocks'] = _build_blocks(raw)
+        _data_cache['memo'] = {}
+        _data_cache['version'] += 1
+        for period in periods:
+            _data_cache['periods'][period] = _data_cache['version']
+        _data_cache['updates'].append(hashlib.sha1(text).hexdigest())
+
+def _memoize(name, func):
+    """
+    Input: A name for a table derived from the raw data, and a function computing it
+    Output: The table, computed at most once per version of the raw data
+    """
+    with _data_lock:
+        _load_raw()
+        memo = _data_cache['memo']
+        if name not in memo:
+            memo[name] = func()
+        return memo[name]
+
 def get_data():
     """
     Input: Excel spreadsheet exported from WasteDataFlow
     Output: Raw data from WasteDataFlow from April 2014 to March 2015,
-    excluding some irrelevant columns.
+    excluding some irrelevant columns. Within period_window(), the rows of the
+    Periods of the window instead.
+
+    The spreadsheet is only parsed once per process (see preload() and clear_cache()).
+    The returned dataframe is a copy with plain string columns (the cache holds them coded),
+    so it can be modified freely. Rows are grouped by QuestionNumber and ColText;
+    use sort_index() to get the order of the spreadsheet back.
     """
-    raw = pd.read_excel(op.join(data_dir, 'raw_jan14-sep15.xls'), 
-                        sheetname='NotQ100', header= 1)
-    raw = raw.drop(['CollateText','RowOrder','ColOrder','RowIdent',
-                    'ColIdent','CollateID','columngroup'], axis=1)
-    raw = raw[raw.Period != 'Jan 14 - Mar 14']
-    return raw
+    raw = _load_raw()
+    window = _run_state['window']
+    if window is None:
+        keep = ~raw['Period'].isin(excluded_periods)
+    else:
+        keep = raw['Period'].isin(window)
+    return _decode(raw if keep.all() else raw[keep])
+
+def get_rows(question, coltext=None, positive=False, rowtext=None):
+    """
+    Input: QuestionNumber (e.g. 'Q010'), and optionally the ColText within it
+    Output: The rows of get_data() for that question (and column), looked up
+    in the partition index instead of scanning the whole raw data.
+    If positive is True, only rows with Data > 0 are kept, and if rowtext is given,
+    only the rows with that RowText. The rows are filtered on the codes of the cache,
+    and only the rows kept are turned back into strings.
+    Within period_window(), the rows of every Period are returned, as the stages
+    sum over the Periods of the window with _sum_la().
+    """
+    with _data_lock:
+        raw = _load_raw()
+        blocks = _data_cache['blocks']
+    key = question if coltext is None else (question, coltext)
+    start, stop = blocks.get(key, (0, 0))
+    rows = raw.iloc[start:stop]
+    if _run_state['window'] is None:
+        rows = rows[~rows['Period'].isin(excluded_periods)]
+    if positive:
+        rows = rows[rows.Data > 0]
+    if rowtext is not None:
+        rows = rows[rows['RowText'] == rowtext]
+    if _profile['frames']:
+        _profile['frames'][-1]['input rows'] += len(rows)
+    return _decode(rows)
+
+def _period_start(period):
+    #e.g. 'Apr 14 - Jun 14' starts in April 2014
+    return dt.datetime.strptime(period.split(' - ')[0], '%b %y')
+
+def _list_periods():
+    return sorted(_load_raw()['Period'].dropna().unique(), key=_period_start)
+
+def get_periods():
+    """
+    Input: Excel spreadsheet exported from WasteDataFlow
+    Output: List of every Period in the raw data (including excluded_periods), in time order
+    """
+    return list(_memoize('periods', _list_periods))
+
+def _pivot_qtr(rows):
+    """
+    Input: Rows of the raw data, e.g. from get_rows()
+    Output: Data for each local authority and quarter, with one column for each RowText.
+    Gives the same table as
+    rows.pivot_table(values='Data', index=['Authority','Period'], columns='RowText',
+                     aggfunc = lambda x: x).reset_index()
+    but reshapes with unstack instead of calling a Python function for every cell.
+    A ValueError is raised if the same (Authority, Period, RowText) is reported twice.
+    """
+    keys = ['Authority','Period','RowText']
+    #pivot_table leaves out missing values and rows with a missing key
+    rows = rows[rows['Data'].notnull() & rows[keys].notnull().all(axis=1)]
+    data = rows.set_index(keys)['Data']
+    duplicated = data.index.duplicated()
+    if duplicated.any():
+        raise ValueError('More than one value for (Authority, Period, RowText): '
+                         + ', '.join(str(key) for key in data.index[duplicated][:5]))
+    return data.unstack('RowText').reset_index()
+
+def _pivot_periods(question, coltext):
+    """
+    Input: QuestionNumber and ColText, as for get_rows()
+    Output: The same table as _pivot_qtr(get_rows(question, coltext)), put together from
+    one pivot for each Period. The pivot of a Period is kept until its rows change,
+    so after update_period() only the updated Periods are pivoted again.
+    """
+    rows = get_rows(question, coltext)
+    with _data_lock:
+        periods = _data_cache['periods']
+        partials = _data_cache['partials']
+    frames = []
+    for period in sorted(rows['Period'].dropna().unique()):
+        key = (question, coltext, period)
+        if key not in partials or partials[key][0] != periods.get(period):
+            partials[key] = (periods.get(period), _pivot_qtr(rows[rows['Period'] == period]))
+        frames.append(partials[key][1])
+    if not frames:
+        return _pivot_qtr(rows)
+    pivot = pd.concat(frames, ignore_index=True)
+    columns = sorted(set(pivot.columns) - set(['Authority','Period']))
+    pivot = pivot[['Authority','Period'] + columns].sort(['Authority','Period'])
+    pivot.index = range(0, len(pivot))
+    pivot.columns.name = 'RowText'
+    return pivot
+
+def _cumulative_sums(qtr):
+    """
+    Input: Table with Authority, Period and numeric columns
+    Output: (authorities, columns, sums, counts), where sums[i] (authorities x columns) is the
+    sum over the first i Periods of get_periods(), and counts[i] the number of values in it
+    """
+    periods = get_periods()
+    authorities = np.array(sorted(qtr['Authority'].dropna().unique()), dtype=object)
+    columns = [col for col in qtr.columns if col not in ('Authority','Period')]
+    values = qtr[columns].values.astype(float)
+    period = pd.Index(periods).get_indexer(qtr['Period'])
+    authority = pd.Index(authorities).get_indexer(qtr['Authority'])
+    keep = (period >= 0) & (authority >= 0)
+    sums = np.zeros((len(periods) + 1, len(authorities), len(columns)))
+    counts = np.zeros((len(periods) + 1, len(authorities), len(columns)))
+    np.add.at(sums, (period[keep] + 1, authority[keep]), np.where(np.isnan(values[keep]), 0, values[keep]))
+    np.add.at(counts, (period[keep] + 1, authority[keep]), ~np.isnan(values[keep]))
+    return authorities, columns, sums.cumsum(axis=0), counts.cumsum(axis=0)
+
+def _sum_la(qtr, name):
+    """
+    Input: Table with Authority, Period and numeric columns (e.g. from a get_*_qtr stage),
+    and a name for it that no other table summed with _sum_la() has
+    Output: The sums for each local authority, qtr.groupby('Authority').agg(np.sum).reset_index().
+    Within period_window(), the sums over the Periods of the window, as the difference of two
+    cumulative sums over the Periods in time order. These are computed once for all the windows
+    of a run. An LA with no value for a column in the window gets NaN, and LAs with no values
+    at all in the window are left out.
+    In quarterly(), the sums for each local authority and Period (of the window) instead.
+    """
+    window = _run_state['window']
+    if _run_state['quarterly']:
+        if window is not None:
+            qtr = qtr[qtr['Period'].isin(window)]
+        return qtr.groupby(['Authority','Period']).agg(np.sum).reset_index()
+    if window is None:
+        return qtr.groupby('Authority').agg(np.sum).reset_index()
+    with pipeline_run():
+        memo = _run_state['memo']
+        if ('cumulative', name) not in memo:
+            memo[('cumulative', name)] = _cumulative_sums(qtr)
+        authorities, columns, sums, counts = memo[('cumulative', name)]
+    periods = get_periods()
+    first, last = periods.index(window[0]), periods.index(window[-1]) + 1
+    total = sums[last] - sums[first]
+    count = counts[last] - counts[first]
+    present = count.sum(axis=1) > 0
+    la = pd.DataFrame(np.where(count > 0, total, np.nan)[present], columns=columns)
+    la.insert(0, 'Authority', authorities[present])
+    la.columns.name = qtr.columns.name
+    return la
+
+def preload():
+    """
+    Parse the WasteDataFlow spreadsheet now (if not already cached),
+    so that later calls to get_data() return immediately.
+    """
+    _load_raw()
+
+def clear_cache():
+    """
+    Forget the cached raw data. The next call to get_data() parses the spreadsheet again.
+    """
+    with _data_lock:
+        _data_cache['key'] = None
+        _data_cache['raw'] = None
+        _data_cache['blocks'] = None
+        _data_cache['memo'] = {}
+        _data_cache['periods'] = {}
+        _data_cache['partials'] = {}
+        _data_cache['updates'] = []
+
+def convert_data():
+    """
+    Input: Excel spreadsheet exported from WasteDataFlow
+    Output: Path of the Feather sidecar written next to the spreadsheet.
+    Later calls to get_data() (in any process) memory-map the sidecar instead of
+    parsing Excel, until the content of the spreadsheet changes.
+    """
+    if feather is None:
+        raise ImportError('pyarrow is required to write the Feather sidecar')
+    path = op.join(data_dir, raw_file)
+    digest = _sidecar_digest(path)
+    sidecar = _sidecar_path(path, digest)
+    if not op.exists(sidecar):
+        _write_sidecar(read_export(path, questions=raw_questions), path, digest)
+    return sidecar
+
+"""
+Stage graph
+
+"""
+#Each get_* stage below is registered with the stages it depends on.
+#Within a run (one top-level call, or a pipeline_run() block), a stage is computed
+#at most once for the same arguments, and later calls receive a copy of the result.
+#Only the stages that are actually called are evaluated.
+_stages = {}
+#'calls' is the stack of stage calls being computed, 'window' the Periods
+#set by period_window() (None for April 2014 to March 2015), and 'quarterly' is set by quarterly()
+_run_state = {'memo': None, 'last_run': [], 'calls': [], 'window': None, 'quarterly': False}
+
+@contextlib.contextmanager
+def pipeline_run():
+    """
+    Share stage results between several calls, e.g.
+
+    with massflow_baseline.pipeline_run():
+        baseline = massflow_baseline.get_massflow_baseline()
+        com_res_drs = massflow_baseline.get_com_res_drs()
+
+    computes get_com_res_drs() only once. Nested runs join the outer one.
+    """
+    if _run_state['memo'] is not None:
+        yield
+        return
+    _run_state['memo'] = {}
+    _run_state['last_run'] = []
+    try:
+        yield
+    finally:
+        _run_state['memo'] = None
+
+@contextlib.contextmanager
+def period_window(periods):
+    """
+    Compute the stages for the given consecutive Periods (see get_periods()) instead of
+    April 2014 to March 2015, e.g.
+
+    with massflow_baseline.period_window(['Jul 14 - Sep 14','Oct 14 - Dec 14',
+                                          'Jan 15 - Mar 15','Apr 15 - Jun 15']):
+        baseline = massflow_baseline.get_massflow_baseline()
+
+    Stage results are kept apart for each window. See also get_rolling_baselines().
+    """
+    periods = list(periods)
+    order = get_periods()
+    missing = [period for period in periods if period not in order]
+    if missing:
+        raise ValueError('Periods not in the raw data: ' + ', '.join(missing))
+    first = order.index(periods[0]) if periods else 0
+    if not periods or order[first:first + len(periods)] != periods:
+        raise ValueError('A window must be consecutive Periods in time order: ' + ', '.join(periods))
+    previous = _run_state['window']
+    _run_state['window'] = tuple(periods)
+    try:
+        yield
+    finally:
+        _run_state['window'] = previous
+
+@contextlib.contextmanager
+def quarterly():
+    """
+    Compute the stages for each local authority and Period instead of summing the Periods, e.g.
+
+    with massflow_baseline.quarterly():
+        baseline = massflow_baseline.get_massflow_baseline()
+
+    The *_la and *_drs tables then have one row for each (Authority, Period), and the baseline
+    one table for each Period (see get_cube_baseline()). All the Periods go through each stage
+    together, in one pass. Can be combined with period_window().
+    """
+    previous = _run_state['quarterly']
+    _run_state['quarterly'] = True
+    try:
+        yield
+    finally:
+        _run_state['quarterly'] = previous
+
+def _la_keys():
+    #Columns identifying a row of the *_la and *_drs tables
+    return ['Authority','Period'] if _run_state['quarterly'] else ['Authority']
+
+def _call_key(func, args, kwargs):
+    #Calls that differ only in spelling out default arguments share a key
+    callargs = inspect.getcallargs(func, *args, **kwargs)
+    return tuple(sorted(callargs.items()))
+
+def _stage(*deps):
+    """
+    Register the decorated function as a stage depending on the named stages
+    """
+    def register(func):
+        name = func.__name__
+        _stages[name] = {'func': func, 'deps': deps}
+        @functools.wraps(func)
+        def stage(*args, **kwargs):
+            with pipeline_run():
+                memo = _run_state['memo']
+                key = (name, _call_key(func, args, kwargs), _run_state['window'],
+                       _run_state['quarterly'])
+                with _trace(key) as frame:
+                    if key not in memo:
+                        _run_state['calls'].append(key)
+                        try:
+                            memo[key] = _cached_call(name, func, args, kwargs, key)
+                        finally:
+                            _run_state['calls'].pop()
+                        _run_state['last_run'].append(key)
+                    elif frame is not None:
+                        frame['cache'] = 'run memo'
+                    if frame is not None:
+                        frame['output rows'] = _row_count(memo[key])
+                    #Callers are free to modify what they get back
+                    return copy.copy(memo[key])
+        return stage
+    return register
+
+def _stage_order(target):
+    """
+    Input: Name of a stage
+    Output: The stage and everything it can depend on, dependencies first
+    """
+    order = []
+    def visit(name, path):
+        if name in order:
+            return
+        if name in path:
+            raise ValueError('Stage graph has a cycle: ' + ' -> '.join(path + [name]))
+        for dep in _stages.get(name, {'deps': ()})['deps']:
+            visit(dep, path + [name])
+        order.append(name)
+    visit(target, [])
+    return order
+
+def explain(target='get_massflow_baseline'):
+    """
+    Input: Name of a stage
+    Output: Text listing the stages the target can depend on, in evaluation order,
+    each with its direct dependencies. Stages evaluated during the last run are marked with *.
+    """
+    evaluated = set(key[0] for key in _run_state['last_run'])
+    lines = []
+    for name in _stage_order(target):
+        deps = _stages[name]['deps'] if name in _stages else ()
+        mark = '*' if name in evaluated else ' '
+        lines.append(mark + ' ' + name + (' <- ' + ', '.join(deps) if deps else ''))
+    return '\n'.join(lines)
+
+def get_stage_graph_dot(target='get_massflow_baseline'):
+    """
+    Input: Name of a stage
+    Output: The dependency graph of the target in Graphviz dot format
+    """
+    lines = ['digraph massflow {', '    rankdir=LR;']
+    for name in _stage_order(target):
+        for dep in (_stages[name]['deps'] if name in _stages else ()):
+            lines.append('    "' + dep + '" -> "' + name + '";')
+    lines.append('}')
+    return '\n'.join(lines)
+
+"""
+Profiling
+
+"""
+#Set by profile_stages(): the list that stage records go to, and the stage calls in progress
+_profile = {'records': None, 'frames': [], 'start': 0.0, 'memory': False}
+_wall_time = getattr(time, 'perf_counter', time.time)
+_cpu_time = getattr(time, 'process_time', None) or time.clock
 
+_trace_columns = ['Stage','Arguments','Window','Quarterly','Cache','Depth','Start',
+                  'Wall Time','Self Wall Time','CPU Time','Self CPU Time','Peak Memory',
+                  'Input Rows','Output Rows']
+
+@contextlib.contextmanager
+def profile_stages(memory = True):
+    """
+    Record every stage call made within the block, e.g.
+
+    with massflow_baseline.profile_stages() as trace:
+        massflow_baseline.get_massflow_baseline()
+    print(massflow_baseline.get_stage_summary(trace))
+    massflow_baseline.write_stage_trace(trace, op.join('data', 'trace.json'))
+
+    trace is a list with a dict for each call (see _trace_columns): the stage and its arguments,
+    whether it was computed or found in the run memo or the result cache, its wall and CPU time
+    in seconds, with and without the stages it called, the peak memory in bytes allocated while
+    it ran (with memory=True and tracemalloc from Python 3.9, otherwise NaN), the rows it read
+    (from get_rows() and the stages it called) and the rows it returned.
+    Stages computed in worker processes (see max_workers) are not recorded.
+    """
+    if _profile['records'] is not None:
+        #Nested blocks record into the outer one
+        yield _profile['records']
+        return
+    records = []
+    memory = memory and tracemalloc is not None and hasattr(tracemalloc, 'reset_peak')
+    started = memory and not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    _profile.update(records=records, frames=[], start=_wall_time(), memory=memory)
+    try:
+        yield records
+    finally:
+        _profile.update(records=None, frames=[])
+        if started:
+            tracemalloc.stop()
+
+def _row_count(table):
+    return len(table) if isinstance(table, (pd.DataFrame, pd.Series, list, np.ndarray)) else np.nan
+
+def _fold_peak():
+    #tracemalloc keeps a single peak, so it is passed on to every call in progress before it is reset
+    current, peak = tracemalloc.get_traced_memory()
+    for frame in _profile['frames']:
+        frame['peak'] = max(frame['peak'], peak)
+    tracemalloc.reset_peak()
+    return current
+
+@contextlib.contextmanager
+def _trace(key):
+    """
+    Input: The key of a stage call
+    Output: Context in which the stage is called, giving the dict the stage wrapper fills in
+    (None outside profile_stages()). A record of the call is added to the trace when it ends.
+    """
+    if _profile['records'] is None:
+        yield None
+        return
+    frames = _profile['frames']
+    current = _fold_peak() if _profile['memory'] else 0
+    frame = {'cache': 'computed', 'memory': current, 'peak': current, 'input rows': 0,
+             'output rows': np.nan, 'children wall': 0.0, 'children cpu': 0.0}
+    depth = len(frames)
+    frames.append(frame)
+    start, cpu = _wall_time(), _cpu_time()
+    try:
+        yield frame
+    finally:
+        wall, cpu = _wall_time() - start, _cpu_time() - cpu
+        if _profile['memory']:
+            _fold_peak()
+        frames.pop()
+        if frames:
+            frames[-1]['children wall'] += wall
+            frames[-1]['children cpu'] += cpu
+            frames[-1]['input rows'] += 0 if np.isnan(frame['output rows']) else frame['output rows']
+        _profile['records'].append({
+            'Stage': key[0], 'Arguments': dict(key[1]), 'Window': key[2], 'Quarterly': key[3],
+            'Cache': frame['cache'], 'Depth': depth, 'Start': start - _profile['start'],
+            'Wall Time': wall, 'Self Wall Time': wall - frame['children wall'],
+            'CPU Time': cpu, 'Self CPU Time': cpu - frame['children cpu'],
+            'Peak Memory': frame['peak'] - frame['memory'] if _profile['memory'] else np.nan,
+            'Input Rows': frame['input rows'], 'Output Rows': frame['output rows']})
+
+def get_stage_summary(trace):
+    """
+    Input: Records from profile_stages()
+    Output: A dataframe with one row for each stage: its number of calls, how many of them were
+    computed or found in the run memo or the result cache, its total time with and without
+    the stages it called, its largest peak memory in MB, and the rows it read and returned.
+    The stages taking the most time of their own come first.
+    """
+    calls = pd.DataFrame(trace, columns=_trace_columns)
+    for col in _trace_columns[_trace_columns.index('Start'):]:
+        calls[col] = calls[col].astype(float)
+    calls['Calls'] = 1
+    calls['Computed'] = (calls['Cache'] == 'computed').astype(int)
+    calls['Run Memo Hits'] = (calls['Cache'] == 'run memo').astype(int)
+    calls['Result Cache Hits'] = (calls['Cache'] == 'result cache').astype(int)
+    columns = ['Calls','Computed','Run Memo Hits','Result Cache Hits','Wall Time','Self Wall Time',
+               'CPU Time','Self CPU Time','Input Rows','Output Rows']
+    summary = calls.groupby('Stage')[columns].sum()
+    summary['Peak Memory (MB)'] = calls.groupby('Stage')['Peak Memory'].max() / (1024 * 1024)
+    return summary.sort('Self Wall Time', ascending=False).reset_index()
+
+def write_stage_trace(trace, path):
+    """
+    Input: Records from profile_stages(), and the path of the file to write
+    Output: None. The calls are written as a JSON trace in the Chrome trace event format,
+    which chrome://tracing or https://ui.perfetto.dev can display as a timeline
+    """
+    events = []
+    for record in sorted(trace, key=lambda record: record['Start']):
+        args = dict((name, None if isinstance(value, float) and np.isnan(value) else value)
+                    for name, value in record.items() if name not in ('Stage','Start','Wall Time'))
+        events.append({'name': record['Stage'], 'cat': record['Cache'], 'ph': 'X',
+                       'ts': record['Start'] * 1e6, 'dur': record['Wall Time'] * 1e6,
+                       'pid': os.getpid(), 'tid': 0, 'args': args})
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f, default=repr)
+
+"""
+Output
+
+"""
+#Stages hand the tables they produce to output_sink, a function sink(name, table, options)
+#where options are the arguments of the stage that produced the table.
+#The default sink only keeps the latest table of each name in outputs. To write
+#date-stamped CSV files in data_dir instead (e.g. data/hhkerb_rec_drs_2711.csv):
+#massflow_baseline.output_sink = massflow_baseline.csv_sink
+outputs = {}
+
+#File names used by csv_sink, filled in from the options of the stage
+csv_names = {'massflow_baseline': ('massflow_baseline_{reuse}reuse_{reject}reject_'
+                                   '{hhkerb_rec_method}_{com_rec_method}'),
+             'massflow_cube': ('massflow_cube_{reuse}reuse_{reject}reject_'
+                               '{hhkerb_rec_method}_{com_rec_method}')}
+
+def memory_sink(name, table, options):
+    outputs[name] = table
+
+def csv_sink(name, table, options):
+    table.to_csv(op.join(data_dir, (csv_names.get(name, name).format(**options) + '_'
+                                    + dt.datetime.today().strftime("%d%m")
+                                    + '.csv')),
+                 encodings = 'utf-8')
+
+output_sink = memory_sink
+
+def _output(name, table):
+    calls = _run_state['calls']
+    output_sink(name, table, dict(calls[-1][1]) if calls else {})
+
+@contextlib.contextmanager
+def _redirect_output(sink):
+    global output_sink
+    previous = output_sink
+    output_sink = sink
+    try:
+        yield
+    finally:
+        output_sink = previous
+
+@contextlib.contextmanager
+def buffered_output(sink = None, background = False):
+    """
+    Hold back the tables output within the block, and hand them to sink (output_sink by default)
+    in one go when the block ends, e.g.
+
+    with massflow_baseline.buffered_output(massflow_baseline.csv_sink):
+        massflow_baseline.run_scenarios()
+
+    With background=True, a background thread hands them to the sink as they come instead,
+    so that computing does not wait for the disk. The block ends once they are all written.
+    """
+    sink = output_sink if sink is None else sink
+    if not background:
+        buffered = []
+        with _redirect_output(lambda name, table, options: buffered.append((name, table, options))):
+            yield
+        for name, table, options in buffered:
+            sink(name, table, options)
+        return
+
+    pending = queue.Queue()
+    errors = []
+    def write():
+        while True:
+            item = pending.get()
+            if item is None:
+                return
+            try:
+                sink(*item)
+            except Exception as e:
+                errors.append(e)
+    writer = threading.Thread(target=write)
+    writer.daemon = True
+    writer.start()
+    try:
+        with _redirect_output(lambda name, table, options: pending.put((name, table, options))):
+            yield
+    finally:
+        pending.put(None)
+        writer.join()
+    if errors:
+        raise errors[0]
+
+@contextlib.contextmanager
+def run_store(path):
+    """
+    Collect every table output within the block, and write them all to one file at path
+    when the block ends, e.g.
+
+    with massflow_baseline.run_store(op.join('data', 'sweep.pkl')):
+        massflow_baseline.run_scenarios()
+
+    The file can be read back with load_run_store()
+    """
+    records = []
+    with _redirect_output(lambda name, table, options: records.append((name, options, table))):
+        yield
+    pd.to_pickle(records, path)
+
+def load_run_store(path):
+    """
+    Input: Path of a file written by run_store()
+    Output: dict of output name -> one dataframe with all the tables of that name,
+    with the options of the stage that produced each table in the first columns
+    """
+    tables = collections.OrderedDict()
+    for name, options, table in pd.read_pickle(path):
+        table = table.copy()
+        for position, option in enumerate(sorted(options)):
+            table.insert(position, option, options[option])
+        tables.setdefault(name, []).append(table)
+    return collections.OrderedDict((name, pd.concat(frames, ignore_index=True))
+                                   for name, frames in tables.items())
+
+"""
+Result cache
+
+"""
+#Results of get_massflow_baseline() and the get_*_drs stages are also kept on disk, in
+#result_cache_dir under data_dir, so that repeating a call is fast even in a new session.
+#An entry is found by a hash of the stage, its arguments, the spreadsheet, the composition
+#rates and fallback rules, and this module's code, so a change to any of them is a miss.
+#Once the entries take more than result_cache_size bytes, the least recently used ones are removed.
+#Set result_cache_dir to None to turn it off.
+result_cache_dir = 'cache'
+result_cache_size = 256 * 1024 * 1024
+
+_digests = {}
+
+def _code_digest():
+    if 'code' not in _digests:
+        path = op.splitext(op.abspath(__file__))[0] + '.py'
+        _digests['code'] = _file_hash(path) if op.exists(path) else ''
+    return _digests['code']
+
+def _workbook_digest():
+    #Hashing the spreadsheet is only repeated when it changes
+    path = op.join(data_dir, raw_file)
+    key = _source_key(path)
+    if _digests.get('workbook', (None,))[0] != key:
+        _digests['workbook'] = (key, _file_hash(path))
+    digest = _digests['workbook'][1]
+    #Including the rows from update_period()
+    with _data_lock:
+        if _data_cache['key'] == key and _data_cache['updates']:
+            digest = hashlib.sha1(' '.join([digest] + _data_cache['updates']).encode('utf-8')).hexdigest()
+    return digest
+
+def _rates_digest():
+    tables = [composition_rates, baseline_constants, market_parameters, hhkerb_rec_rules,
+              hhkerb_rec_overrides, hhkerb_rec_excluded, hwrcs_rec_rules]
+    return hashlib.sha1(repr([sorted(table.items()) for table in tables]).encode('utf-8')).hexdigest()
+
+def _persistent(func):
+    """
+    Mark the decorated stage to be kept in the result cache
+    """
+    func.persistent = True
+    return func
+
+def _evict(directory):
+    entries = []
+    for path in glob.glob(op.join(directory, '*.pkl.z')):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for mtime, size, path in entries)
+    for mtime, size, path in sorted(entries):
+        if total <= result_cache_size:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= size
+
+def _cached_call(name, func, args, kwargs, key):
+    """
+    Input: A stage, its arguments and their _call_key()
+    Output: The result of the stage, from the result cache if it is there. The tables it output
+    (see _output()) are kept with it, and handed to output_sink again when it is found.
+    """
+    if result_cache_dir is None or not getattr(func, 'persistent', False):
+        return func(*args, **kwargs)
+    directory = op.join(data_dir, result_cache_dir)
+    #The rows get_data() loads and keeps depend on raw_questions and excluded_periods
+    questions = None if raw_questions is None else sorted(raw_questions)
+    digest = hashlib.sha1(repr((key, _workbook_digest(), _rates_digest(), sorted(excluded_periods),
+                                questions, _code_digest(), pd.__version__)).encode('utf-8')).hexdigest()
+    path = op.join(directory, name + '_' + digest[:24] + '.pkl.z')
+    try:
+        with open(path, 'rb') as f:
+            result, records = pickle.loads(zlib.decompress(f.read()))
+        #Mark as recently used
+        os.utime(path, None)
+    except (IOError, OSError, EOFError, ValueError, zlib.error, pickle.UnpicklingError):
+        pass
+    else:
+        if _profile['frames']:
+            _profile['frames'][-1]['cache'] = 'result cache'
+        for record in records:
+            output_sink(*record)
+        return result
+
+    records = []
+    forward = output_sink
+    def record(name, table, options):
+        records.append((name, table, options))
+        forward(name, table, options)
+    with _redirect_output(record):
+        result = func(*args, **kwargs)
+    try:
+        if not op.isdir(directory):
+            os.makedirs(directory)
+        #A temporary file of its own for every writer, even threads of one process,
+        #moved over the entry in one step
+        handle, tmp = tempfile.mkstemp(prefix=op.basename(path) + '.', suffix='.tmp', dir=directory)
+        try:
+            with os.fdopen(handle, 'wb') as f:
+                f.write(zlib.compress(pickle.dumps((result, records), pickle.HIGHEST_PROTOCOL)))
+            _replace_file(tmp, path)
+        finally:
+            if op.exists(tmp):
+                os.remove(tmp)
+        _evict(directory)
+    except (IOError, OSError):
+        #Not fatal, e.g. read-only data directory, or another process creating it at the same time
+        pass
+    return result
+
+def clear_result_cache():
+    """
+    Remove every entry of the result cache
+    """
+    if result_cache_dir is None:
+        return
+    for path in glob.glob(op.join(data_dir, result_cache_dir, '*.pkl.z')):
+        os.remove(path)
+
+@_stage('get_data')
 def get_pop():
     """
     Input: Table from get_data()
-    Output: Population for each local authority
+    Output: Population for each local authority (and Period, in quarterly())
     """
-    raw = get_data()
-    pop_qtr = raw[(raw.QuestionNumber == 'Q001') & (raw.RowText == 'Population of Authority')]
+    pop_qtr = get_rows('Q001', rowtext='Population of Authority')
+    window = _run_state['window']
+    if _run_state['quarterly']:
+        if window is not None:
+            pop_qtr = pop_qtr[pop_qtr['Period'].isin(window)]
+        pop_qtr = pop_qtr.groupby(['Authority','Period'])['Data'].last().reset_index()
+        return pop_qtr.rename(columns={'Data':'Population'})
+    if window is not None:
+        #Use the latest population reported in the window
+        pop_qtr = pop_qtr[pop_qtr['Period'].isin(window)]
+        order = pop_qtr['Period'].map(lambda period: window.index(period))
+        pop_qtr = pop_qtr.iloc[np.argsort(order.values, kind='mergesort')]
+        pop_qtr = pop_qtr.groupby('Authority')['Data'].last().reset_index()
     pop_la = pop_qtr[['Authority','Data']].drop_duplicates().rename(columns={'Data':'Population'})
     pop_la = pop_la.sort('Authority').reset_index().drop('index', axis=1)
     return pop_la
 
+"""
+Composition rates
+
+"""
+drs_materials = ['DRS Glass Bottles','DRS Plastic Bottles','DRS Ferrous Cans','DRS Aluminium Cans',
+                 'DRS Beverage Cartons']
+stream_names = ['Household Kerbside Recycling','Household Kerbside Residual',
+                'HWRCs Recycling','HWRCs Residual',
+                'Commercial Recycling','Commercial Residual',
+                'Litter Residual']
+
+#Every rate used to derive DRS materials from the WasteDataFlow tonnages.
+#The *_drs functions read their rates from here, so a changed value changes the baseline.
+#get_massflow_uncertainty() can draw any of them from a distribution instead.
+composition_rates = collections.OrderedDict([
+    #Household kerbside recycling: WRAP rates
+    ('hhkerb_rec_mixed_glass', 0.6564),
+    ('hhkerb_rec_co_glass', 0.1599),
+    ('hhkerb_rec_bottles', 0.9626),
+    ('hhkerb_rec_plastics', 0.6847),
+    ('hhkerb_rec_swansea', 0.5738),
+    ('hhkerb_rec_co_plastics', 0.0669),
+    ('hhkerb_rec_steel', 0.1953),
+    ('hhkerb_rec_alum', 0.9483),
+    ('hhkerb_rec_mixed_fer', 0.1453),
+    ('hhkerb_rec_mixed_alum', 0.2429),
+    ('hhkerb_rec_co_fer', 0.0101),
+    ('hhkerb_rec_co_alum', 0.0169),
+    ('hhkerb_rec_co_bev', 0.0031),
+    #Household kerbside recycling: Eunomia rates (method='Eunomia')
+    ('hhkerb_rec_mixed_glass_eunomia', 0.80),
+    ('hhkerb_rec_plastics_eunomia', 0.22),
+    #Share of co-mingled recycling that is not rejected (comingled_reject='Yes')
+    ('hhkerb_rec_reject', 0.8915),
+    #Household kerbside residual: WRAP rates
+    ('hhkerb_res_glass', 0.0204),
+    ('hhkerb_res_plastics', 0.0151),
+    ('hhkerb_res_ferrous', 0.001554),
+    ('hhkerb_res_alum', 0.003255),
+    ('hhkerb_res_cartons', 0.0037),
+    #Household kerbside residual: Eunomia rates (method='Eunomia')
+    ('hhkerb_res_glass_eunomia', 0.0215),
+    ('hhkerb_res_plastics_eunomia', 0.006),
+    #HWRCs recycling: Eunomia/ZWS rates, and WRAP MRF rates for co-mingled materials
+    #(also used for commercial recycling)
+    ('hwrcs_rec_mixed_glass', 0.75),
+    ('hwrcs_rec_clear_glass', 0.35),
+    ('hwrcs_rec_co_glass', 0.0245),
+    ('hwrcs_rec_plastics', 0.50),
+    ('hwrcs_rec_co_plastics', 0.16528),
+    ('hwrcs_rec_mixed_fer', 0.80),
+    ('hwrcs_rec_mixed_alum', 0.20),
+    ('hwrcs_rec_co_fer', 0.1123),
+    ('hwrcs_rec_co_alum', 0.0379),
+    ('hwrcs_rec_co_bev', 0.00669),
+    #HWRCs residual: ZWS rates
+    ('hwrcs_res_glass', 0.011665),
+    ('hwrcs_res_plastics', 0.0066),
+    ('hwrcs_res_ferrous', 0.001824),
+    ('hwrcs_res_alum', 0.00248),
+    ('hwrcs_res_cartons', 0.0007),
+    #Commercial recycling: ZWS recycling rates of each material, i.e. recycled / (recycled + residual)
+    ('com_rec_glass', 0.6),
+    ('com_rec_plastics', 0.3),
+    ('com_rec_ferrous', 0.4),
+    ('com_rec_alum', 0.4),
+    ('com_rec_cartons', 0.3),
+    #Commercial residual: ZWS rates
+    ('com_res_glass', 0.0216),
+    ('com_res_plastics', 0.0234),
+    ('com_res_ferrous', 0.0068),
+    ('com_res_alum', 0.0032),
+    ('com_res_cartons', 0.0028),
+    #Litter residual: ZWS rates
+    ('lit_res_glass', 0.0688),
+    ('lit_res_plastics', 0.0712),
+    ('lit_res_ferrous', 0.0183),
+    ('lit_res_alum', 0.0369),
+    ('lit_res_cartons', 0.0045),
+    #WRAP estimation of the share of Street Cleaning that is Mechanical Sweeping
+    ('lit_res_sweeping', 0.5),
+])
+
+#Other constants of the baseline table
+baseline_constants = collections.OrderedDict([
+    #The Percent Contribution row is the Total row divided by this (a total weight of
+    #140.2216 thousand tonnes, whereas get_total_weight_drs_list() sums to about 151)
+    ('percent_divisor', 1.402216),
+])
+
+def _drs_frame(table, values):
+    """
+    Input: Table with one row for each local authority, and dict of DRS material -> tonnages
+    for each of its rows
+    Output: Dataframe with the Authority (and Period, in quarterly()) and one column for each DRS material
+    """
+    keys = _la_keys()
+    drs = pd.DataFrame(columns=keys + drs_materials)
+    for key in keys:
+        drs[key] = table[key]
+    for material in drs_materials:
+        drs[material] = values[material]
+    return drs
+
+def _fill_missing(values, fallback):
+    if isinstance(values, _Linear) or isinstance(fallback, _Linear):
+        return _select(np.isnan(_value(values)), fallback, values)
+    return np.where(np.isnan(values), fallback, values)
+
+def _column(table, name):
+    #Values of a table column, or its terms in compile_baseline()
+    column = table[name]
+    return column if isinstance(column, _Linear) else column.values.astype(float)
+
+def _median_rate(merge, column):
+    """
+    Input: Table with Population, and one of its columns
+    Output: The median of the column per population over the local authorities
+    (over those of the same Period, in quarterly())
+    """
+    rate = merge[column]/merge['Population']
+    if _run_state['quarterly']:
+        return rate.groupby(merge['Period']).transform('median')
+    return rate.median()
+
+"""
+Fallback rules
+
+"""
+#The recycling streams derive each DRS material from the most specific data an LA has reported,
+#falling back to broader columns. A stream's rules are an OrderedDict of DRS material -> list of rules,
+#in order of preference. A rule is a list of (source column, names of the composition rates
+#multiplied with it), and 'dry_rec' stands for the column chosen with the dry_rec option.
+#An LA uses the first rule with any of its source columns reported (or no rule, giving NaN).
+#The rules are compiled once into a selection mask (LAs x rules) for each DRS material,
+#and evaluated as a masked product of the source table with a (source column x rule) coefficient matrix
+
+def _dry_rec_column(dry_rec):
+    return {'Sum': 'sum_dry_rec', 'Comingled': 'Co mingled materials'}[dry_rec]
+
+def _reported_la(rows):
+    """
+    Input: Rows from get_rows()
+    Output: Dataframe indexed by Authority, with one column for each RowText that is True
+    where the LA reported a value in any quarter (even a zero).
+    In quarterly(), indexed by (Authority, Period) for what was reported in each quarter.
+    """
+    rows = rows[rows['Data'].notnull()]
+    if _run_state['window'] is not None:
+        rows = rows[rows['Period'].isin(_run_state['window'])]
+    return rows.groupby(_la_keys() + ['RowText']).size().unstack('RowText').notnull()
+
+def _compile_rules(source, reported, rules, dry_rec = 'Sum', overrides = None, excluded = None,
+                   computed = ('sum_dry_rec',)):
+    """
+    Input: Table with one row for each local authority, reported data from _reported_la(),
+    fallback rules, the dry_rec option, rules replacing the fallback rules of a DRS material
+    for particular LAs as {(Authority, DRS material): rules}, and source columns not to be used
+    for particular LAs as {Authority: [source column]}. Computed columns count as reported for every LA.
+    Output: dict of the source values (LAs x source columns, missing values as 0),
+    and for each DRS material the rules selected by any LA with their selection mask
+    """
+    overrides = {} if overrides is None else overrides
+    excluded = {} if excluded is None else excluded
+    authority = source['Authority'].values
+    keys = _la_keys()
+    rows = authority if len(keys) == 1 else pd.MultiIndex.from_arrays([source[key].values for key in keys])
+    resolve = lambda rule: tuple((_dry_rec_column(dry_rec) if col == 'dry_rec' else col, tuple(names))
+                                 for col, names in rule)
+    chains = list(rules.values()) + list(overrides.values())
+    columns = sorted(set(col for chain in chains for rule in chain for col, names in resolve(rule)))
+
+    has = (reported.reindex(index=rows, columns=columns, fill_value=False).values.astype(bool)
+           .reshape(len(authority), len(columns)))
+    for j, col in enumerate(columns):
+        if col in computed:
+            has[:, j] = True
+    for i, name in enumerate(authority):
+        for col in excluded.get(name, []):
+            has[i, columns.index(col)] = False
+
+    materials = collections.OrderedDict()
+    for material, default in rules.items():
+        selected = []
+        for i, name in enumerate(authority):
+            chain = [resolve(rule) for rule in overrides.get((name, material), default)]
+            selected.append(next((rule for rule in chain
+                                  if any(has[i, columns.index(col)] for col, names in rule)), None))
+        terms = []
+        for rule in selected:
+            if rule is not None and rule not in terms:
+                terms.append(rule)
+        mask = np.array([[rule == term for term in terms] for rule in selected], dtype=bool)
+        materials[material] = (terms, mask.reshape(len(authority), len(terms)))
+
+    values = source[columns].values.astype(float)
+    return {'columns': columns, 'source': np.where(np.isnan(values), 0, values), 'materials': materials,
+            'authority': authority}
+
+def _evaluate_rules(compiled, rates):
+    """
+    Input: Rules from _compile_rules(), and composition rates (see _hhkerb_rec_drs_values())
+    Output: dict of DRS material -> tonnages for each local authority
+    """
+    if isinstance(compiled['source'], dict):
+        return _evaluate_rules_linear(compiled, rates)
+    columns = compiled['columns']
+    names = set(name for terms, mask in compiled['materials'].values()
+                for rule in terms for col, rule_names in rule for name in rule_names)
+    sampled = any(np.ndim(rates[name]) > 0 for name in names)
+    samples = max([np.size(rates[name]) for name in names] + [1])
+
+    values = {}
+    for material, (terms, mask) in compiled['materials'].items():
+        #Coefficient matrix (samples x source columns x rules)
+        coefficients = np.zeros((samples, len(columns), len(terms)))
+        for j, rule in enumerate(terms):
+            for col, rule_names in rule:
+                coefficient = functools.reduce(lambda x, name: x * rates[name], rule_names, 1.0)
+                coefficients[:, columns.index(col), j] += np.ravel(coefficient)
+        flows = (np.einsum('ac,scr->sar', compiled['source'], coefficients) * mask).sum(axis=2)
+        flows[:, ~mask.any(axis=1)] = np.nan
+        values[material] = flows if sampled else flows[0]
+    return values
+
 """
 Household Kerbside Recycling
 
 """
 
+@_stage('get_data')
 def get_hhkerb_rec_qtr():
-    raw = get_data()
-    hhkerb_rec = raw[(raw.QuestionNumber == 'Q010') & 
-                     (raw.ColText == 'Tonnage collected for recycling')]
-    hhkerb_rec_qtr = hhkerb_rec.pivot_table(values='Data', index=['Authority','Period'],
-                                         columns='RowText', aggfunc = lambda x: x).reset_index()
+    hhkerb_rec_qtr = _pivot_periods('Q010', 'Tonnage collected for recycling')
     return hhkerb_rec_qtr
 
+@_stage('get_hhkerb_rec_qtr')
 def get_hhkerb_rec_la():
     hhkerb_rec_qtr = get_hhkerb_rec_qtr()
-    hhkerb_rec_la = (hhkerb_rec_qtr.groupby('Authority').agg(np.sum).reset_index()
+    hhkerb_rec_la = (_sum_la(hhkerb_rec_qtr, 'hhkerb_rec')
                      .drop(['Green garden waste only','Mixed garden and food waste',
                             'Waste food only'],axis=1))
     #Generate the sum of recycling materials (mostly just 'Co mingled materials' if applicable to LAs)
     hhkerb_rec_la['sum_dry_rec'] = hhkerb_rec_la.sum(axis=1)
-    hhkerb_rec_la = hhkerb_rec_la[['Authority','Mixed glass','Mixed Plastic Bottles',
-                                   'Plastics','Steel cans','Aluminium cans','Mixed cans',
-                                   'Composite food and beverage cartons','Co mingled materials',
-                                   'sum_dry_rec']]
+    hhkerb_rec_la = hhkerb_rec_la[_la_keys() + ['Mixed glass','Mixed Plastic Bottles',
+                                                 'Plastics','Steel cans','Aluminium cans','Mixed cans',
+                                                 'Composite food and beverage cartons',
+                                                 'Co mingled materials','sum_dry_rec']]
     return hhkerb_rec_la
 
+@_stage('get_data', 'get_hhkerb_rec_la')
 def get_hhkerb_recreu_la():
-    raw = get_data()
-    hhkerb_reu = raw[(raw.QuestionNumber == 'Q010') & 
-                     (raw.ColText == 'Tonnage Collected for Reuse') & 
-                     (raw.Data > 0)]
+    hhkerb_reu = get_rows('Q010', 'Tonnage Collected for Reuse', positive=True)
     #It has been verified that all the materials selected above can be added to sum_dry_rec
-    hhkerb_reu_la = (hhkerb_reu.groupby('Authority')['Data'].agg(np.sum).to_frame().reset_index()
-                         .rename(columns={'Data':'sum_dry_rec'}))
+    hhkerb_reu_la = (_sum_la(hhkerb_reu[['Authority','Period','Data']], 'hhkerb_reu')
+                     [_la_keys() + ['Data']].rename(columns={'Data':'sum_dry_rec'}))
 
     #Add hhkerb_reu_la to hhkerb_rec_la (only some LAs have data for hhkerb_reu_la)
     hhkerb_rec_la = get_hhkerb_rec_la()
-    merge = hhkerb_rec_la.merge(hhkerb_reu_la, how='left', on='Authority')
+    merge = hhkerb_rec_la.merge(hhkerb_reu_la, how='left', on=_la_keys())
     merge['sum_dry_rec_y'] = merge['sum_dry_rec_y'].replace(np.NaN, 0)
     merge['sum_dry_rec'] = merge['sum_dry_rec_x'] + merge['sum_dry_rec_y']
     merge = merge.drop(['sum_dry_rec_x', 'sum_dry_rec_y'], axis=1)
     return merge
 
-def get_hhkerb_rec_drs(reuse='No', method='WRAP', dry_rec = 'Sum', comingled_reject = 'Yes'):
-    if reuse == 'No':
-        hhkerb_rec_drs = get_hhkerb_rec_la()
-    if reuse == 'Yes':
-        hhkerb_rec_drs = get_hhkerb_recreu_la()
-    
-    if comingled_reject == 'Yes':
-        reject_rate = 0.8915
-    if comingled_reject == 'No':
-        reject_rate = 1.0
-    
-    #These are WRAP rates
-    mixed_glass = 0.6564
-    co_glass = 0.1599
-    bottles = 0.9626
-    plastics = 0.6847
-    swansea = 0.5738
-    co_plastics = 0.0669
-    steel = 0.1953
-    alum = 0.9483
-    mixed_fer = 0.1453 
-    mixed_alum = 0.2429
-    co_fer = 0.0101
-    co_alum = 0.0169
-    co_bev = 0.0031
-    if method=='Eunomia':
-        mixed_glass = 0.80
-        plastics = 0.22
-        
-    if dry_rec == 'Sum':
-        dry_rec = 'sum_dry_rec'
-    if dry_rec == 'Comingled':
-        dry_rec = 'Co mingled materials'
-    
-    #DRS Glass Bottles (derived from 'Mixed glass' or 'sum_dry_rec')
-    #For those that have data for 'Mixed glass'
-    hhkerb_rec_drs['DRS Glass Bottles'] = hhkerb_rec_drs['Mixed glass'] * mixed_glass
-    #Using co-mingled materials
-    hhkerb_rec_drs['DRS Glass Bottles'] = (hhkerb_rec_drs['DRS Glass Bottles']
-                                            .replace(np.NaN, 
-                                                     hhkerb_rec_drs[dry_rec] * reject_rate * co_glass))
-    
-    #DRS Plastic Bottles (derived from 'Mixed Plastic Bottles', 'Plastics', or 'sum_dry_rec')
+@_stage('get_data')
+def get_hhkerb_rec_reported():
+    """
+    Input: Table from get_data()
+    Output: Which recycling columns each LA reported for Question 10 (see _reported_la())
+    """
+    return _reported_la(get_rows('Q010', 'Tonnage collected for recycling'))
+
+#Fallback rules for household kerbside recycling (see _compile_rules())
+hhkerb_rec_rules = collections.OrderedDict([
+    #DRS Glass Bottles (derived from 'Mixed glass' or co-mingled dry recycling)
+    ('DRS Glass Bottles', [[('Mixed glass', ['hhkerb_rec_mixed_glass'])],
+                           [('dry_rec', ['hhkerb_rec_reject', 'hhkerb_rec_co_glass'])]]),
+    #DRS Plastic Bottles (derived from 'Mixed Plastic Bottles', 'Plastics', or co-mingled)
     #Mostly, 'Mixed Plastic Bottles' are treated as PET, HDPE, and Other. 
     #So DRS is assumed to be only PET and HDPE
-    hhkerb_rec_drs['DRS Plastic Bottles'] = hhkerb_rec_drs['Mixed Plastic Bottles'] * bottles
     #If info not provided from 'Mixed Plastic Bottles', use 'Plastics'. 
     #For most of these LAs, plastics are dense plastics.
-    hhkerb_rec_drs['DRS Plastic Bottles'] = (hhkerb_rec_drs['DRS Plastic Bottles']
-                                             .replace(np.NaN,hhkerb_rec_drs['Plastics'] * plastics))
-    #For Swansea, Plastics are dense plastics plus plastic film, use WRAP adjusted rate
-    hhkerb_rec_drs['DRS Plastic Bottles'] = np.where(hhkerb_rec_drs['Authority'] 
-                                                     == 'City  and County of Swansea ',
-                                                     hhkerb_rec_drs['Plastics'] * swansea, 
-                                                     hhkerb_rec_drs['DRS Plastic Bottles'])
-    #For LAs with co-mingled materials
-    hhkerb_rec_drs['DRS Plastic Bottles'] = (hhkerb_rec_drs['DRS Plastic Bottles']
-                                             .replace(np.NaN,
-                                                      hhkerb_rec_drs[dry_rec]*reject_rate*co_plastics))
-    
+    ('DRS Plastic Bottles', [[('Mixed Plastic Bottles', ['hhkerb_rec_bottles'])],
+                             [('Plastics', ['hhkerb_rec_plastics'])],
+                             [('dry_rec', ['hhkerb_rec_reject', 'hhkerb_rec_co_plastics'])]]),
     #DRS Ferrous Cans & DRS Aluminium Cans
-    #If 'Steel cans' or 'Aluminium cans' exists
-    hhkerb_rec_drs['DRS Ferrous Cans'] = hhkerb_rec_drs['Steel cans'] * steel
-    hhkerb_rec_drs['DRS Aluminium Cans'] = hhkerb_rec_drs['Aluminium cans'] * alum
-    #Use 'Mixed cans' if available
-    #For Neath Port Talbot and Powys, their data from Mixed Cans is incomplete. So skip those values.
-    #DRS Ferrous Cans
-    hhkerb_rec_drs['DRS Ferrous Cans'] = np.where((hhkerb_rec_drs['Mixed cans'].notnull()) & 
-                                                  (hhkerb_rec_drs['Authority'] 
-                                                  != 'Neath Port Talbot CBC') &
-                                                  (hhkerb_rec_drs['Authority'] 
-                                                  != 'Powys County Council'),
-                                                  hhkerb_rec_drs['Mixed cans'] * mixed_fer,
-                                                  hhkerb_rec_drs['DRS Ferrous Cans'])
-    hhkerb_rec_drs['DRS Ferrous Cans'] = (hhkerb_rec_drs['DRS Ferrous Cans']
-                                          .replace(np.NaN,hhkerb_rec_drs[dry_rec]*reject_rate*co_fer))
-    #DRS Aluminium Cans
-    hhkerb_rec_drs['DRS Aluminium Cans'] = np.where((hhkerb_rec_drs['Mixed cans'].notnull()) &
-                                                    (hhkerb_rec_drs['Authority'] 
-                                                     != 'Neath Port Talbot CBC') &
-                                                    (hhkerb_rec_drs['Authority'] 
-                                                     != 'Powys County Council'),
-                                                    hhkerb_rec_drs['Mixed cans'] * mixed_alum,
-                                                    hhkerb_rec_drs['DRS Aluminium Cans'])
-    hhkerb_rec_drs['DRS Aluminium Cans'] = (hhkerb_rec_drs['DRS Aluminium Cans']
-                                            .replace(np.NaN,
-                                                     hhkerb_rec_drs[dry_rec]*reject_rate*co_alum))
-
+    #Use 'Mixed cans' if available, otherwise 'Steel cans' or 'Aluminium cans'
+    ('DRS Ferrous Cans', [[('Mixed cans', ['hhkerb_rec_mixed_fer'])],
+                          [('Steel cans', ['hhkerb_rec_steel'])],
+                          [('dry_rec', ['hhkerb_rec_reject', 'hhkerb_rec_co_fer'])]]),
+    ('DRS Aluminium Cans', [[('Mixed cans', ['hhkerb_rec_mixed_alum'])],
+                            [('Aluminium cans', ['hhkerb_rec_alum'])],
+                            [('dry_rec', ['hhkerb_rec_reject', 'hhkerb_rec_co_alum'])]]),
     #DRS Beverage Cartons
     #For two LAs with info on beverage cartons, use the specific data
-    hhkerb_rec_drs['DRS Beverage Cartons'] = hhkerb_rec_drs['Composite food and beverage cartons']
     #For the rest, use WRAP rate of 0.31% on the sum of dry recycling
-    hhkerb_rec_drs['DRS Beverage Cartons'] = (hhkerb_rec_drs['DRS Beverage Cartons']
-                                               .replace(np.NaN,
-                                                        hhkerb_rec_drs[dry_rec]*reject_rate*co_bev))
-    hhkerb_rec_drs = hhkerb_rec_drs[['Authority','DRS Glass Bottles','DRS Plastic Bottles',
-                                     'DRS Ferrous Cans','DRS Aluminium Cans','DRS Beverage Cartons']]
-    
-    #Export to .csv
-    hhkerb_rec_drs.to_csv(op.join(data_dir,('hhkerb_rec_drs_'
-                                            + dt.datetime.today().strftime("%d%m")
-                                            + '.csv')), 
-                          encodings = 'utf-8')
+    ('DRS Beverage Cartons', [[('Composite food and beverage cartons', [])],
+                              [('dry_rec', ['hhkerb_rec_reject', 'hhkerb_rec_co_bev'])]]),
+])
+#For Swansea, Plastics are dense plastics plus plastic film, use WRAP adjusted rate
+hhkerb_rec_overrides = {
+    ('City  and County of Swansea ', 'DRS Plastic Bottles'):
+        [[('Plastics', ['hhkerb_rec_swansea'])],
+         [('dry_rec', ['hhkerb_rec_reject', 'hhkerb_rec_co_plastics'])]],
+}
+#For Neath Port Talbot and Powys, their data from Mixed Cans is incomplete. So skip those values.
+hhkerb_rec_excluded = {'Neath Port Talbot CBC': ['Mixed cans'],
+                       'Powys County Council': ['Mixed cans']}
+
+def _compile_hhkerb_rec(hhkerb_rec_la, dry_rec = 'Sum'):
+    """
+    Input: Table from get_hhkerb_rec_la() or get_hhkerb_recreu_la()
+    Output: The compiled fallback rules of household kerbside recycling (see _compile_rules())
+    """
+    return _compile_rules(hhkerb_rec_la, get_hhkerb_rec_reported(), hhkerb_rec_rules, dry_rec=dry_rec,
+                          overrides=hhkerb_rec_overrides, excluded=hhkerb_rec_excluded)
+
+def _hhkerb_rec_drs_values(hhkerb_rec, rates, method='WRAP', comingled_reject = 'Yes'):
+    """
+    Input: Rules from _compile_hhkerb_rec(), and composition rates.
+    A rate can be an array of samples with shape (samples, 1).
+    Output: dict of DRS material -> tonnages for each local authority
+    (with shape (samples, authorities) if any rate is an array of samples)
+    """
+    rates = dict(rates)
+    #These are WRAP rates
+    if method=='Eunomia':
+        rates['hhkerb_rec_mixed_glass'] = rates['hhkerb_rec_mixed_glass_eunomia']
+        rates['hhkerb_rec_plastics'] = rates['hhkerb_rec_plastics_eunomia']
+    if comingled_reject == 'No':
+        rates['hhkerb_rec_reject'] = 1.0
+    return _evaluate_rules(hhkerb_rec, rates)
+
+@_stage('get_hhkerb_rec_la', 'get_hhkerb_recreu_la', 'get_hhkerb_rec_reported')
+@_persistent
+def get_hhkerb_rec_drs(reuse='No', method='WRAP', dry_rec = 'Sum', comingled_reject = 'Yes'):
+    if reuse == 'No':
+        hhkerb_rec_la = get_hhkerb_rec_la()
+    if reuse == 'Yes':
+        hhkerb_rec_la = get_hhkerb_recreu_la()
+    
+    hhkerb_rec_drs = _drs_frame(hhkerb_rec_la,
+                                _hhkerb_rec_drs_values(_compile_hhkerb_rec(hhkerb_rec_la, dry_rec=dry_rec),
+                                                       composition_rates, method=method,
+                                                       comingled_reject=comingled_reject))
+    
+    _output('hhkerb_rec_drs', hhkerb_rec_drs)
     return hhkerb_rec_drs
 
+"""
+Residual Waste (Question 23)
+
+"""
+#Household kerbside, HWRCs, commercial and litter residual all come from the same
+#Question 23 table, so it is pivoted once and shared
+
+def _pivot_res_qtr():
+    return _pivot_periods('Q023', 'Tonnage')
+
+@_stage('get_data')
+def get_res_qtr():
+    """
+    Input: Table from get_data()
+    Output: Question 23 tonnages for each local authority and quarter,
+    with one column for each type of residual waste
+    """
+    #The rows from get_rows() depend on excluded_periods, or are every Period within period_window()
+    periods = tuple(excluded_periods) if _run_state['window'] is None else 'every Period'
+    return _memoize(('res_qtr', periods), _pivot_res_qtr).copy()
+
 """
 Household Kerbside Residual Waste
 
 """
 
+@_stage('get_res_qtr')
 def get_hhkerb_res_qtr():
-    raw = get_data()
-    res = (raw[(raw.QuestionNumber == 'Q023') & (raw.ColText == 'Tonnage')]
-             .pivot_table(values='Data', index=['Authority','Period'],
-                          columns='RowText', aggfunc = lambda x: x)
-             .reset_index())
+    res = get_res_qtr()
     hhkerb_res_qtr = res[['Authority','Period','Collected household waste : Regular Collection']]
     return hhkerb_res_qtr
 
+@_stage('get_hhkerb_res_qtr')
 def get_hhkerb_res_la():
     hhkerb_res_qtr = get_hhkerb_res_qtr()
-    hhkerb_res_la = hhkerb_res_qtr.groupby('Authority').agg(np.sum).reset_index()
+    hhkerb_res_la = _sum_la(hhkerb_res_qtr, 'hhkerb_res')
     return hhkerb_res_la
 
+@_stage('get_data', 'get_hhkerb_res_la')
 def get_hhkerb_resrej_la():
-    raw = get_data()
-    hhkerb_rej_qtr = raw[(raw.QuestionNumber == 'Q010') & 
-                     (raw.ColText == 'Tonnage collected for recycling but actually rejected/disposed')&
-                     (raw.Data > 0)]
-    hhkerb_rej_la = (hhkerb_rej_qtr.groupby('Authority').agg(np.sum).reset_index()
-                     .drop(['Period','QuestionNumber','QuText','RowText',
-                            'ColText','MaterialGroup'],axis=1))
+    hhkerb_rej_qtr = get_rows('Q010', 'Tonnage collected for recycling but actually rejected/disposed',
+                              positive=True)
+    hhkerb_rej_la = (_sum_la(hhkerb_rej_qtr[['Authority','Period','Data']], 'hhkerb_rej')
+                     [_la_keys() + ['Data']])
  
     #Merge rejected recycling (hhkerb_rej_la) into residual
     hhkerb_res_la = get_hhkerb_res_la()
-    merge = hhkerb_res_la.merge(hhkerb_rej_la, how='left', on='Authority')
+    merge = hhkerb_res_la.merge(hhkerb_rej_la, how='left', on=_la_keys())
     merge['Data'] = merge['Data'].replace(np.NaN, 0)
     merge['Collected household waste : Regular Collection'] = merge['Collected household waste : Regular Collection']+ merge['Data']
     merge = merge.drop(['Data'],axis=1)
     return merge
 
+def _hhkerb_res_drs_values(hhkerb_res_la, rates, method='WRAP'):
+    """
+    Input: Table from get_hhkerb_res_la() or get_hhkerb_resrej_la(), and composition rates
+    (see _hhkerb_rec_drs_values())
+    Output: dict of DRS material -> tonnages for each local authority
+    """
+    residual = _column(hhkerb_res_la, 'Collected household waste : Regular Collection')
+    #These are WRAP rates
+    #Wrap rate is 0.0204, Eunomia rate is ...
+    glass = rates['hhkerb_res_glass']
+    #WRAP rate is 0.0151, Eunomia rate is 0.006048
+    plastics = rates['hhkerb_res_plastics']
+    if method=='Eunomia':
+        glass = rates['hhkerb_res_glass_eunomia']
+        plastics = rates['hhkerb_res_plastics_eunomia']
+    return {'DRS Glass Bottles': residual*glass,
+            'DRS Plastic Bottles': residual*plastics,
+            'DRS Ferrous Cans': residual*rates['hhkerb_res_ferrous'],
+            'DRS Aluminium Cans': residual*rates['hhkerb_res_alum'],
+            'DRS Beverage Cartons': residual*rates['hhkerb_res_cartons']}
+
+@_stage('get_hhkerb_res_la', 'get_hhkerb_resrej_la')
+@_persistent
 def get_hhkerb_res_drs(reject = 'No', method='WRAP'):
     if reject == 'No':
         hhkerb_res_la = get_hhkerb_res_la()
     if reject == 'Yes':
         hhkerb_res_la = get_hhkerb_resrej_la()
     
-    #These are WRAP rates
-    glass = 0.0204
-    plastics = 0.0151
-    ferrous = 0.001554
-    alum = 0.003255
-    cartons = 0.0037
-    if method=='Eunomia':
-        glass = 0.0215
-        plastics = 0.006
-    
-    hhkerb_res_drs = pd.DataFrame(columns=['Authority','DRS Glass Bottles',
-                                             'DRS Plastic Bottles','DRS Ferrous Cans',
-                                             'DRS Aluminium Cans','DRS Beverage Cartons'])
-    hhkerb_res_drs['Authority'] = hhkerb_res_la['Authority']
-    #Wrap rate is 0.0204, Eunomia rate is ...
-    hhkerb_res_drs['DRS Glass Bottles'] = hhkerb_res_la['Collected household waste : Regular Collection']*glass
-    #WRAP rate is 0.0151, Eunomia rate is 0.006048
-    hhkerb_res_drs['DRS Plastic Bottles'] = hhkerb_res_la['Collected household waste : Regular Collection']*plastics
-    hhkerb_res_drs['DRS Ferrous Cans'] = hhkerb_res_la['Collected household waste : Regular Collection']*ferrous
-    hhkerb_res_drs['DRS Aluminium Cans'] = hhkerb_res_la['Collected household waste : Regular Collection']*alum
-    hhkerb_res_drs['DRS Beverage Cartons'] = hhkerb_res_la['Collected household waste : Regular Collection']*cartons
-    hhkerb_res_drs.to_csv(op.join(data_dir, ('hhkerb_res_drs_'
-                                               + dt.datetime.today().strftime("%d%m")
-                                               + '.csv')), 
-                            encodings = 'utf-8')
+    hhkerb_res_drs = _drs_frame(hhkerb_res_la,
+                                _hhkerb_res_drs_values(hhkerb_res_la, composition_rates, method=method))
+    _output('hhkerb_res_drs', hhkerb_res_drs)
     return hhkerb_res_drs
 
 """
@@ -327,19 +1683,16 @@ HWRCs Recycling
 
 """
 
+@_stage('get_data')
 def get_hwrcs_rec_la():    
-    drslist = ['Authority','Brown glass','Clear glass','Green glass','Mixed glass',
+    drslist = _la_keys() + ['Brown glass','Clear glass','Green glass','Mixed glass',
                                    'Mixed Plastic Bottles','Plastics',
                                    'Aluminium cans','Steel cans','Mixed cans',
                                    'Composite food and beverage cartons',
                                    'Co mingled materials','sum_dry_rec']
-    raw = get_data()
     #Get recycling data from CA sites (Question 16)
-    hwrcs_rec_ca = (raw[(raw.QuestionNumber == 'Q016') & 
-                        (raw.ColText == 'Tonnage collected for recycling')]
-                         .pivot_table(values='Data', index=['Authority','Period'],
-                                      columns='RowText', aggfunc = lambda x: x).reset_index())
-    hwrcs_rec_ca_la = (hwrcs_rec_ca.groupby('Authority').agg(np.sum).reset_index()
+    hwrcs_rec_ca = _pivot_periods('Q016', 'Tonnage collected for recycling')
+    hwrcs_rec_ca_la = (_sum_la(hwrcs_rec_ca, 'hwrcs_rec_ca')
                      .drop(['Green garden waste only'],axis=1))
     #Get dry recycling
     hwrcs_rec_ca_la['sum_dry_rec'] = hwrcs_rec_ca_la.sum(axis=1)
@@ -347,136 +1700,118 @@ def get_hwrcs_rec_la():
     hwrcs_rec_ca_la = hwrcs_rec_ca_la[drslist]    
     
     #Get recycling data from bring sites (Question 17)
-    hwrcs_rec_bring = (raw[(raw.QuestionNumber == 'Q017') & 
-                           (raw.ColText == 'Tonnage collected for recycling')]
-                         .pivot_table(values='Data', index=['Authority','Period'],
-                                      columns='RowText', aggfunc = lambda x: x).reset_index())
-    hwrcs_rec_bring_la = (hwrcs_rec_bring.groupby('Authority').agg(np.sum).reset_index()
+    hwrcs_rec_bring = _pivot_periods('Q017', 'Tonnage collected for recycling')
+    hwrcs_rec_bring_la = (_sum_la(hwrcs_rec_bring, 'hwrcs_rec_bring')
                           .drop(['Green garden waste only'],axis=1))
     #Get sum of dry recycling
     hwrcs_rec_bring_la['sum_dry_rec'] = hwrcs_rec_bring_la.sum(axis=1)
     #Keep DRS relevant columns, drop the rest
     hwrcs_rec_bring_la = hwrcs_rec_bring_la[drslist]
-    #Add second to last row 'Vale of Glamorgan Council' and re-assign index
-    hwrcs_rec_bring_la = (hwrcs_rec_bring_la.merge(hwrcs_rec_ca_la[['Authority']],
-                                                   how='outer',on='Authority').sort('Authority'))
-    hwrcs_rec_bring_la.index = range(0,len(hwrcs_rec_bring_la))
-    #Before adding the two dataframes together, turn all missing values to 0
-    hwrcs_rec_ca_la = hwrcs_rec_ca_la.replace(np.NaN,0)
-    hwrcs_rec_bring_la = hwrcs_rec_bring_la.replace(np.NaN,0)
+    #Combine the two dataframes by LA (e.g. 'Vale of Glamorgan Council' has no bring sites)
+    #and re-assign index
+    merge = hwrcs_rec_ca_la.merge(hwrcs_rec_bring_la, how='outer', on=_la_keys()).sort(_la_keys())
+    merge.index = range(0,len(merge))
+    #Before adding the two together, turn all missing values to 0
+    merge = merge.replace(np.NaN,0)
     #Add values of Question 16 and Question 17 together
-    merge = (hwrcs_rec_ca_la + hwrcs_rec_bring_la)
-    merge['Authority'] = hwrcs_rec_bring_la['Authority']
-    return merge
+    for col in drslist[len(_la_keys()):]:
+        merge[col] = merge[col + '_x'] + merge[col + '_y']
+    return merge[drslist]
 
+@_stage('get_data', 'get_hwrcs_rec_la')
 def get_hwrcs_recreu_la():
-    raw = get_data()
     #Get reuse data from CA sites (Question 16)
-    hwrcs_reu_ca = raw[(raw.QuestionNumber == 'Q016') & 
-                     (raw.ColText == 'Tonnage collected for reuse') & 
-                     (raw.Data > 0)]
+    hwrcs_reu_ca = get_rows('Q016', 'Tonnage collected for reuse', positive=True)
     #It has been verified that all the materials selected above can be added to sum_dry_rec
-    hwrcs_reu_ca_la = (hwrcs_reu_ca.groupby('Authority')['Data'].agg(np.sum).to_frame().reset_index()
-                         .rename(columns={'Data':'sum_dry_rec'}))
+    hwrcs_reu_ca_la = (_sum_la(hwrcs_reu_ca[['Authority','Period','Data']], 'hwrcs_reu_ca')
+                       [_la_keys() + ['Data']].rename(columns={'Data':'sum_dry_rec'}))
     
     #Get reuse data from bring sites (Question 17)
-    hwrcs_reu_bring = raw[(raw.QuestionNumber == 'Q017') & 
-                     (raw.ColText == 'Tonnage collected for reuse') & 
-                     (raw.Data > 0)]
+    hwrcs_reu_bring = get_rows('Q017', 'Tonnage collected for reuse', positive=True)
     #It has been verified that all the materials selected above can be added to sum_dry_rec
-    hwrcs_reu_bring_la = (hwrcs_reu_bring.groupby('Authority')['Data']
-                          .agg(np.sum).to_frame().reset_index()
+    hwrcs_reu_bring_la = (_sum_la(hwrcs_reu_bring[['Authority','Period','Data']], 'hwrcs_reu_bring')
+                          [_la_keys() + ['Data']]
                           .rename(columns={'Data':'sum_dry_rec'}))
     #Combine the two dataframes (add up reuse data for each LA)
-    merge = hwrcs_reu_ca_la.merge(hwrcs_reu_bring_la, how='outer', on='Authority')
+    merge = hwrcs_reu_ca_la.merge(hwrcs_reu_bring_la, how='outer', on=_la_keys())
     merge = merge.replace(np.NaN, 0)
     merge['sum_dry_rec'] = merge['sum_dry_rec_x'] + merge['sum_dry_rec_y']
     merge = merge.drop(['sum_dry_rec_x','sum_dry_rec_y'],axis=1)
         
     #Merge reuse data into hwrcs_rec_la from get_hwrcs_rec_la()
     hwrcs_rec_la = get_hwrcs_rec_la()
-    merge = hwrcs_rec_la.merge(merge, how='left', on='Authority')
+    merge = hwrcs_rec_la.merge(merge, how='left', on=_la_keys())
     merge = merge.replace(np.NaN, 0)
     merge['sum_dry_rec'] = merge['sum_dry_rec_x'] + merge['sum_dry_rec_y']
     merge = merge.drop(['sum_dry_rec_x','sum_dry_rec_y'],axis=1)
-    merge.to_csv(op.join(data_dir, ('hwrcs_rec_la_'+ dt.datetime.today()
-                                    .strftime("%d%m")+ '.csv')),encodings = 'utf-8')
+    _output('hwrcs_rec_la', merge)
     return merge
 
-def get_hwrcs_rec_drs(reuse = 'No', dry_rec = 'Sum'):
-    if reuse == 'No':
-        hwrcs_rec_drs = get_hwrcs_rec_la()
-    if reuse is 'Yes':
-        hwrcs_rec_drs = get_hwrcs_recreu_la()
-    
-    #Use Eunomia's rates
-    #Use WRAP rates from its 2009 MRF Quality Assessment Study for co-mingled materials
-    mixed_glass = 0.75
-    clear_glass = 0.35
-    co_glass = 0.0245
-    plastics = 0.50
-    co_plastics = 0.16528
-    mixed_fer = 0.80 
-    mixed_alum = 0.20
-    co_fer = 0.1123
-    co_alum = 0.0379
-    co_bev = 0.00669
-    
-    if dry_rec == 'Sum':
-        dry_rec = 'sum_dry_rec'
-    if dry_rec == 'Comingled':
-        dry_rec = 'Co mingled materials'
-    
+@_stage('get_data')
+def get_hwrcs_rec_reported():
+    """
+    Input: Table from get_data()
+    Output: Which recycling columns each LA reported for either Question 16 or 17 (see _reported_la())
+    """
+    rows = pd.concat([get_rows('Q016', 'Tonnage collected for recycling'),
+                      get_rows('Q017', 'Tonnage collected for recycling')])
+    return _reported_la(rows)
+
+#Fallback rules for HWRCs recycling (see _compile_rules())
+#Use Eunomia's rates
+#Use WRAP rates from its 2009 MRF Quality Assessment Study for co-mingled materials
+hwrcs_rec_rules = collections.OrderedDict([
     #DRS Glass Bottles (derived from 'Brown glass','Clear glass','Green glass',
     #'Mixed glass', or co-mingled dry recycling materials)
-    hwrcs_rec_drs['DRS Glass Bottles'] = (hwrcs_rec_drs['Mixed glass'] * mixed_glass 
-                                          + hwrcs_rec_drs['Clear glass'] * clear_glass
-                                          + hwrcs_rec_drs['Brown glass'] 
-                                          + hwrcs_rec_drs['Green glass'])
-    hwrcs_rec_drs['DRS Glass Bottles'] = (hwrcs_rec_drs['DRS Glass Bottles']
-                                            .replace(0, 
-                                                     hwrcs_rec_drs[dry_rec]*co_glass))
-    
+    ('DRS Glass Bottles', [[('Mixed glass', ['hwrcs_rec_mixed_glass']),
+                            ('Clear glass', ['hwrcs_rec_clear_glass']),
+                            ('Brown glass', []),
+                            ('Green glass', [])],
+                           [('dry_rec', ['hwrcs_rec_co_glass'])]]),
     #DRS Plastic Bottles (derived from 'Mixed Plastic Bottles', 'Plastics', or co-mingled)
     #Use data from 'Mixed Plastic Bottles'. If unavailable, use data from 'Plastics'
     #'Mixed Plastic Bottles' are treated as 100% DRS, and Eunomia rate for 'Plastics' is 50%
-    hwrcs_rec_drs['DRS Plastic Bottles'] = hwrcs_rec_drs['Mixed Plastic Bottles']
-    hwrcs_rec_drs['DRS Plastic Bottles'] = (hwrcs_rec_drs['DRS Plastic Bottles']
-                                            .replace(0,hwrcs_rec_drs['Plastics'] * plastics))
-    hwrcs_rec_drs['DRS Plastic Bottles'] = (hwrcs_rec_drs['DRS Plastic Bottles']
-                                             .replace(0,hwrcs_rec_drs[dry_rec] * co_plastics))
-    
+    ('DRS Plastic Bottles', [[('Mixed Plastic Bottles', [])],
+                             [('Plastics', ['hwrcs_rec_plastics'])],
+                             [('dry_rec', ['hwrcs_rec_co_plastics'])]]),
     #DRS Ferrous Cans & DRS Aluminium Cans
     #If 'Steel cans' or 'Aluminium cans' exists, use that info
-    hwrcs_rec_drs['DRS Ferrous Cans'] = hwrcs_rec_drs['Steel cans']
-    hwrcs_rec_drs['DRS Aluminium Cans'] = hwrcs_rec_drs['Aluminium cans']
     #Use 'Mixed cans' if 'Steel cans' or 'Aluminium cans' don't exist
-    hwrcs_rec_drs['DRS Ferrous Cans'] = (hwrcs_rec_drs['DRS Ferrous Cans']
-                                             .replace(0,hwrcs_rec_drs['Mixed cans'] * mixed_fer))
     #If none of the above exists, use sum of dry recycling, with WRAP MRF rate being ???
-    hwrcs_rec_drs['DRS Ferrous Cans'] = (hwrcs_rec_drs['DRS Ferrous Cans']
-                                         .replace(0,hwrcs_rec_drs[dry_rec] * co_fer))
-    #Use 'Mixed cans' if 'Steel cans' or 'Aluminium cans' don't exist
-    hwrcs_rec_drs['DRS Aluminium Cans'] = (hwrcs_rec_drs['DRS Aluminium Cans']
-                                           .replace(0,hwrcs_rec_drs['Mixed cans'] * mixed_alum))
-    #If none of the above exists, use sum of dry recycling, with WRAP MRF rate being ???    
-    hwrcs_rec_drs['DRS Aluminium Cans'] = (hwrcs_rec_drs['DRS Aluminium Cans']
-                                            .replace(0,hwrcs_rec_drs[dry_rec] * co_alum))
-
+    ('DRS Ferrous Cans', [[('Steel cans', [])],
+                          [('Mixed cans', ['hwrcs_rec_mixed_fer'])],
+                          [('dry_rec', ['hwrcs_rec_co_fer'])]]),
+    ('DRS Aluminium Cans', [[('Aluminium cans', [])],
+                            [('Mixed cans', ['hwrcs_rec_mixed_alum'])],
+                            [('dry_rec', ['hwrcs_rec_co_alum'])]]),
     #DRS Beverage Cartons
     #For LAs with info on beverage cartons, use the specific data
-    hwrcs_rec_drs['DRS Beverage Cartons'] = hwrcs_rec_drs['Composite food and beverage cartons']
     #For the rest, use WRAP MRS rate of ??? on the sum of dry recycling
-    hwrcs_rec_drs['DRS Beverage Cartons'] = (hwrcs_rec_drs['DRS Beverage Cartons']
-                                               .replace(0, hwrcs_rec_drs[dry_rec] * co_bev))
-    hwrcs_rec_drs = hwrcs_rec_drs[['Authority','DRS Glass Bottles','DRS Plastic Bottles',
-                                     'DRS Ferrous Cans','DRS Aluminium Cans','DRS Beverage Cartons']]
-    
-    #Export to .csv
-    hwrcs_rec_drs.to_csv(op.join(data_dir,('hwrcs_rec_drs_'
-                                            + dt.datetime.today().strftime("%d%m")
-                                            + '.csv')), 
-                          encodings = 'utf-8')
+    ('DRS Beverage Cartons', [[('Composite food and beverage cartons', [])],
+                              [('dry_rec', ['hwrcs_rec_co_bev'])]]),
+])
+
+def _compile_hwrcs_rec(hwrcs_rec_la, dry_rec = 'Sum'):
+    """
+    Input: Table from get_hwrcs_rec_la() or get_hwrcs_recreu_la()
+    Output: The compiled fallback rules of HWRCs recycling (see _compile_rules()),
+    evaluated with _evaluate_rules()
+    """
+    return _compile_rules(hwrcs_rec_la, get_hwrcs_rec_reported(), hwrcs_rec_rules, dry_rec=dry_rec)
+
+@_stage('get_hwrcs_rec_la', 'get_hwrcs_recreu_la', 'get_hwrcs_rec_reported')
+@_persistent
+def get_hwrcs_rec_drs(reuse = 'No', dry_rec = 'Sum'):
+    if reuse == 'No':
+        hwrcs_rec_la = get_hwrcs_rec_la()
+    if reuse == 'Yes':
+        hwrcs_rec_la = get_hwrcs_recreu_la()
+    
+    hwrcs_rec_drs = _drs_frame(hwrcs_rec_la,
+                               _evaluate_rules(_compile_hwrcs_rec(hwrcs_rec_la, dry_rec=dry_rec),
+                                               composition_rates))
+    
+    _output('hwrcs_rec_drs', hwrcs_rec_drs)
     return hwrcs_rec_drs
 
 """
@@ -484,58 +1819,59 @@ HWRCs Residual Waste
 
 """
 
+@_stage('get_res_qtr')
 def get_hwrcs_res_qtr():
-    raw = get_data()
-    res = (raw[(raw.QuestionNumber == 'Q023') & (raw.ColText == 'Tonnage')]
-             .pivot_table(values='Data', index=['Authority','Period'],
-                          columns='RowText', aggfunc = lambda x: x)
-             .reset_index())
+    res = get_res_qtr()
     hwrcs_res_qtr = res[['Authority','Period','Civic amenity sites waste : Household']]
     return hwrcs_res_qtr
 
+@_stage('get_hwrcs_res_qtr')
 def get_hwrcs_res_la():
     hwrcs_res_qtr = get_hwrcs_res_qtr()
-    hwrcs_res_la = hwrcs_res_qtr.groupby('Authority').agg(np.sum).reset_index()
+    hwrcs_res_la = _sum_la(hwrcs_res_qtr, 'hwrcs_res')
     return hwrcs_res_la
 
+@_stage('get_data', 'get_hwrcs_res_la')
 def get_hwrcs_resrej_la():
-    raw = get_data()
     #The only data of rejected materials is Tonnage collected for recycling but actually rejected / disposed
     #for Question 16
-    hwrcs_rej_ca_qtr = raw[(raw.QuestionNumber == 'Q016') & 
-                     (raw.ColText == 'Tonnage collected for recycling but actually rejected / disposed')&
-                     (raw.Data > 0)]
-    hwrcs_rej_la = (hwrcs_rej_ca_qtr.groupby('Authority').agg(np.sum).reset_index()
-                     .drop(['Period','QuestionNumber','QuText','RowText',
-                            'ColText','MaterialGroup'],axis=1))
+    hwrcs_rej_ca_qtr = get_rows('Q016', 'Tonnage collected for recycling but actually rejected / disposed',
+                                positive=True)
+    hwrcs_rej_la = (_sum_la(hwrcs_rej_ca_qtr[['Authority','Period','Data']], 'hwrcs_rej')
+                    [_la_keys() + ['Data']])
     
     #Merge rejected recycling (hwrcs_rej_la) into residual (hwrcs_res_la)
     hwrcs_res_la = get_hwrcs_res_la()
-    merge = hwrcs_res_la.merge(hwrcs_rej_la, how='left', on='Authority')
+    merge = hwrcs_res_la.merge(hwrcs_rej_la, how='left', on=_la_keys())
     merge['Data'] = merge['Data'].replace(np.NaN, 0)
     merge['Civic amenity sites waste : Household'] = (merge['Civic amenity sites waste : Household'] + merge['Data'])
     merge = merge.drop(['Data'],axis=1)
     return merge
 
+def _hwrcs_res_drs_values(hwrcs_res_la, rates):
+    """
+    Input: Table from get_hwrcs_res_la() or get_hwrcs_resrej_la(), and composition rates
+    (see _hhkerb_rec_drs_values())
+    Output: dict of DRS material -> tonnages for each local authority
+    """
+    residual = _column(hwrcs_res_la, 'Civic amenity sites waste : Household')
+    return {'DRS Glass Bottles': residual*rates['hwrcs_res_glass'],
+            'DRS Plastic Bottles': residual*rates['hwrcs_res_plastics'],
+            'DRS Ferrous Cans': residual*rates['hwrcs_res_ferrous'],
+            'DRS Aluminium Cans': residual*rates['hwrcs_res_alum'],
+            'DRS Beverage Cartons': residual*rates['hwrcs_res_cartons']}
+
+@_stage('get_hwrcs_res_la', 'get_hwrcs_resrej_la')
+@_persistent
 def get_hwrcs_res_drs(reject = 'No'):
     if reject == 'No':
         hwrcs_res_la = get_hwrcs_res_la()
     if reject == 'Yes':
         hwrcs_res_la = get_hwrcs_resrej_la()
 
-    hwrcs_res_drs = pd.DataFrame(columns=['Authority','DRS Glass Bottles',
-                                             'DRS Plastic Bottles','DRS Ferrous Cans',
-                                             'DRS Aluminium Cans','DRS Beverage Cartons'])
-    hwrcs_res_drs['Authority'] = hwrcs_res_la['Authority']
-    hwrcs_res_drs['DRS Glass Bottles'] = hwrcs_res_la['Civic amenity sites waste : Household']*0.011665
-    hwrcs_res_drs['DRS Plastic Bottles'] = hwrcs_res_la['Civic amenity sites waste : Household']*0.0066
-    hwrcs_res_drs['DRS Ferrous Cans'] = hwrcs_res_la['Civic amenity sites waste : Household']*0.001824
-    hwrcs_res_drs['DRS Aluminium Cans'] = hwrcs_res_la['Civic amenity sites waste : Household']*0.00248
-    hwrcs_res_drs['DRS Beverage Cartons'] = hwrcs_res_la['Civic amenity sites waste : Household']*0.0007
-    hwrcs_res_drs.to_csv(op.join(data_dir, ('hwrcs_res_drs_'
-                                               + dt.datetime.today().strftime("%d%m")
-                                               + '.csv')), 
-                            encodings = 'utf-8')
+    hwrcs_res_drs = _drs_frame(hwrcs_res_la,
+                               _hwrcs_res_drs_values(hwrcs_res_la, composition_rates))
+    _output('hwrcs_res_drs', hwrcs_res_drs)
     return hwrcs_res_drs
 
 """
@@ -547,81 +1883,99 @@ Commerical Recycling
 
 #Note, for some rates, use ZWS's rates for HWRCs (e.g. 75% Mixed glass is DRS, 50% Plastics is DRS)
 
+@_stage('get_data')
 def get_com_rec_qtr():
-    raw = get_data()
-    com_rec = raw[(raw.QuestionNumber == 'Q011') &
-                  (raw.ColText == 'Tonnage collected for recycling')]
-    com_rec_qtr = com_rec.pivot_table(values='Data', index=['Authority','Period'],
-                                      columns='RowText', aggfunc = lambda x: x).reset_index()
+    com_rec_qtr = _pivot_periods('Q011', 'Tonnage collected for recycling')
     return com_rec_qtr
 
+@_stage('get_com_rec_qtr')
 def get_com_rec_la():
-    com_rec_la = (get_com_rec_qtr().groupby('Authority').agg(np.sum).reset_index()
+    com_rec_la = (_sum_la(get_com_rec_qtr(), 'com_rec')
                   .drop(['Green garden waste only','Waste food only'],axis=1))
     #Do not need to generate the sum of recycling materials, 
     #nor necessary to include 'Co mingled materials'
     #Note that DRS Beverage Cartons will be generated based on figures from Commercial Residual
-    com_rec_la = com_rec_la[['Authority','Mixed glass','Mixed Plastic Bottles',
-                             'Plastics','Mixed cans', 'Co mingled materials']]
+    com_rec_la = com_rec_la[_la_keys() + ['Mixed glass','Mixed Plastic Bottles',
+                                          'Plastics','Mixed cans', 'Co mingled materials']]
     return com_rec_la
 
-def get_com_rec_drs_int():
+@_stage('get_pop', 'get_com_rec_la')
+def get_com_rec_int_la():
     #Merge in population for interpolation of missing values
-    merge = get_pop().merge(get_com_rec_la(), how='left',on='Authority')
+    merge = get_pop().merge(get_com_rec_la(), how='left',on=_la_keys())
     #For each material, calculate material mass per population from available data, and pick median
     #For LAs with missing data, multiply the median rate and LA's population 
     #to get estimated material mass
     drs_list = ['Mixed glass','Mixed Plastic Bottles','Plastics','Mixed cans']
     for drs in drs_list:
-        merge['Estimated ' + drs] = merge['Population']*((merge[drs]/merge['Population']).median())
+        merge['Estimated ' + drs] = merge['Population']*_median_rate(merge, drs)
         merge['Combined ' + drs] = merge[drs].replace(np.NaN, merge['Estimated ' +  drs])
-    
-    #Initialise dataframe com_rec_drs
-    com_rec_drs = pd.DataFrame(columns=['Authority','DRS Glass Bottles',
-                                        'DRS Plastic Bottles','DRS Ferrous Cans',
-                                        'DRS Aluminium Cans','DRS Beverage Cartons'])
-    com_rec_drs['Authority'] = merge['Authority']
+    return merge
 
+def _com_rec_drs_int_values(com_rec_int_la, com_res_int_la, rates):
+    """
+    Input: Tables from get_com_rec_int_la() and get_com_res_int_la(), and composition rates
+    (see _hhkerb_rec_drs_values())
+    Output: dict of DRS material -> tonnages for each local authority
+    """
+    column = lambda name: _column(com_rec_int_la, name)
+    values = {}
+    
     #For DRS Glass Bottles, use 'Combined Mixed glass' (from raw and estimated data)
     #For now, use ZWS rate for HWRC 'Mixed glass': 75%
-    com_rec_drs['DRS Glass Bottles'] = merge['Combined Mixed glass']*.75
+    values['DRS Glass Bottles'] = column('Combined Mixed glass')*rates['hwrcs_rec_mixed_glass']
     
     #For DRS Plastic Bottles, use 'Mixed Plastic Bottles' or 'Plastics', or respectively estimated data
     #'Mixed Plastic Bottles' are treated as 100% DRS, and HWRCs ZWS rate for 'Plastics' is 50%
-    com_rec_drs['DRS Plastic Bottles'] = merge['Mixed Plastic Bottles']
-    com_rec_drs['DRS Plastic Bottles'] = (com_rec_drs['DRS Plastic Bottles']
-                                            .replace(np.NaN, merge['Plastics']*.5))
-    com_rec_drs['DRS Plastic Bottles'] = (com_rec_drs['DRS Plastic Bottles']
-                                            .replace(np.NaN, merge['Estimated Plastics']*.5))
+    values['DRS Plastic Bottles'] = _fill_missing(column('Mixed Plastic Bottles'),
+                                                  column('Plastics')*rates['hwrcs_rec_plastics'])
+    values['DRS Plastic Bottles'] = _fill_missing(values['DRS Plastic Bottles'],
+                                                  column('Estimated Plastics')*rates['hwrcs_rec_plastics'])
         
     #For DRS Ferrous Cans & DRS Aluminium Cans, use 'Mixed cans' or its estimated data
     #ZWS rates: 20% is aluminium, 80% is ferrous
-    com_rec_drs['DRS Ferrous Cans'] = merge['Combined Mixed cans']*.8
-    com_rec_drs['DRS Aluminium Cans'] = merge['Combined Mixed cans']*.2
+    values['DRS Ferrous Cans'] = column('Combined Mixed cans')*rates['hwrcs_rec_mixed_fer']
+    values['DRS Aluminium Cans'] = column('Combined Mixed cans')*rates['hwrcs_rec_mixed_alum']
     
     #For DRS Beverage Cartons, use ZWS estimated recycling rate of 30% and com_res_drs to interpolate
-    #First, get com_res_drs
-    com_res_drs = get_com_res_drs()
     #For each LA, calculate: DRS Beverage Cartons from com_res_drs multiplied by 30%/70%
-    com_rec_drs['DRS Beverage Cartons'] = com_res_drs['DRS Beverage Cartons']*(.3/.7)
+    cartons = rates['com_rec_cartons']
+    values['DRS Beverage Cartons'] = (_com_res_drs_values(com_res_int_la, rates)['DRS Beverage Cartons']
+                                      *(cartons/(1 - cartons)))
+    return values
+
+@_stage('get_com_rec_int_la', 'get_com_res_int_la')
+@_persistent
+def get_com_rec_drs_int():
+    com_rec_int_la = get_com_rec_int_la()
+    com_rec_drs = _drs_frame(com_rec_int_la,
+                             _com_rec_drs_int_values(com_rec_int_la, get_com_res_int_la(),
+                                                     composition_rates))
     
-    com_rec_drs.to_csv(op.join(data_dir, ('com_rec_drs_' + dt.datetime.today().strftime("%d%m")
-                                          + '.csv')), encodings = 'utf-8')
+    _output('com_rec_drs', com_rec_drs)
     
     return com_rec_drs
 
+def _com_rec_drs_zws_values(com_res_int_la, rates):
+    """
+    Input: Table from get_com_res_int_la(), and composition rates (see _hhkerb_rec_drs_values())
+    Output: dict of DRS material -> tonnages for each local authority
+    """
+    #Recycled tonnage = residual tonnage * recycling rate / (1 - recycling rate)
+    com_res_values = _com_res_drs_values(com_res_int_la, rates)
+    values = {}
+    for material, rate in zip(drs_materials, ['com_rec_glass','com_rec_plastics','com_rec_ferrous',
+                                              'com_rec_alum','com_rec_cartons']):
+        values[material] = com_res_values[material]*(rates[rate]/(1 - rates[rate]))
+    return values
+
+@_stage('get_com_res_int_la')
+@_persistent
 def get_com_rec_drs_zws():
     #This is an alternative method to estimate DRS rates (from com_res_drs and recycling rates)
-    com_res_drs = get_com_res_drs()
-    test_com_rec_drs = pd.DataFrame(columns=['Authority','DRS Glass Bottles',
-                                        'DRS Plastic Bottles','DRS Ferrous Cans',
-                                        'DRS Aluminium Cans','DRS Beverage Cartons'])
-    test_com_rec_drs['Authority'] = com_res_drs['Authority']
-    test_com_rec_drs['DRS Glass Bottles'] = com_res_drs['DRS Glass Bottles']*(.6/.4)
-    test_com_rec_drs['DRS Plastic Bottles'] = com_res_drs['DRS Plastic Bottles']*(.3/.7)
-    test_com_rec_drs['DRS Ferrous Cans'] = com_res_drs['DRS Ferrous Cans']*(.4/.6)
-    test_com_rec_drs['DRS Aluminium Cans'] = com_res_drs['DRS Aluminium Cans']*(.4/.6)
-    test_com_rec_drs['DRS Beverage Cartons'] = com_res_drs['DRS Beverage Cartons']*(.3/.7)
+    com_res_int_la = get_com_res_int_la()
+    test_com_rec_drs = _drs_frame(com_res_int_la,
+                                  _com_rec_drs_zws_values(com_res_int_la, composition_rates))
     return test_com_rec_drs
 
 """
@@ -629,37 +1983,45 @@ Commerical Residual
 
 """
 
+@_stage('get_res_qtr')
 def get_com_res_la():
-    raw = get_data()
-    res = (raw[(raw.QuestionNumber == 'Q023') & (raw.ColText == 'Tonnage')]
-           .pivot_table(values='Data', index=['Authority','Period'],
-                        columns='RowText', aggfunc = lambda x: x).reset_index())
+    res = get_res_qtr()
     com_res_qtr = res[['Authority','Period','Collected non-household waste : Commercial & Industrial']]
-    com_res_la = com_res_qtr.groupby('Authority').agg(np.sum).reset_index()
+    com_res_la = _sum_la(com_res_qtr, 'com_res')
     return com_res_la
 
-def get_com_res_drs():
+@_stage('get_pop', 'get_com_res_la')
+def get_com_res_int_la():
     com_res_la = get_com_res_la()
     #Merge in population for interpolation of missing values
-    merge = get_pop().merge(get_com_res_la(), how='left', on='Authority')
+    merge = get_pop().merge(com_res_la, how='left', on=_la_keys())
     #Calculate material mass per population from available data, and pick median
     #For the three LAs with missing data, multiply the median rate and LA's population 
     #to get estimated material mass
     drs = 'Collected non-household waste : Commercial & Industrial'
-    merge['Estimated ' + drs] = merge['Population']*((merge[drs]/merge['Population']).median())
+    merge['Estimated ' + drs] = merge['Population']*_median_rate(merge, drs)
     merge['Combined ' + drs] = merge[drs].replace(np.NaN, merge['Estimated ' +  drs])
-    
-    #Initialise com_res_drs dataframe
-    com_res_drs = pd.DataFrame(columns=['Authority','DRS Glass Bottles',
-                                    'DRS Plastic Bottles','DRS Ferrous Cans',
-                                    'DRS Aluminium Cans','DRS Beverage Cartons'])
-    com_res_drs['Authority'] = merge['Authority']
+    return merge
+
+def _com_res_drs_values(com_res_int_la, rates):
+    """
+    Input: Table from get_com_res_int_la(), and composition rates (see _hhkerb_rec_drs_values())
+    Output: dict of DRS material -> tonnages for each local authority
+    """
+    residual = _column(com_res_int_la, 'Combined Collected non-household waste : Commercial & Industrial')
     #Aplying ZWS rate: 35% of clear glass is DRS
-    com_res_drs['DRS Glass Bottles'] = merge['Combined ' + drs]*0.0216 
-    com_res_drs['DRS Plastic Bottles'] = merge['Combined ' + drs]*0.0234
-    com_res_drs['DRS Ferrous Cans'] = merge['Combined ' + drs]*0.0068
-    com_res_drs['DRS Aluminium Cans'] = merge['Combined ' + drs]*0.0032
-    com_res_drs['DRS Beverage Cartons'] = merge['Combined ' + drs]*0.0028
+    return {'DRS Glass Bottles': residual*rates['com_res_glass'],
+            'DRS Plastic Bottles': residual*rates['com_res_plastics'],
+            'DRS Ferrous Cans': residual*rates['com_res_ferrous'],
+            'DRS Aluminium Cans': residual*rates['com_res_alum'],
+            'DRS Beverage Cartons': residual*rates['com_res_cartons']}
+
+@_stage('get_com_res_int_la')
+@_persistent
+def get_com_res_drs():
+    com_res_int_la = get_com_res_int_la()
+    com_res_drs = _drs_frame(com_res_int_la,
+                             _com_res_drs_values(com_res_int_la, composition_rates))
     return com_res_drs
 
 """
@@ -681,100 +2043,327 @@ Litter Residual
 #Litter residual is calculated using the following equation:
 #Street Cleaning (Q023) - Flytipping - Mechanical Sweeping - Bin Litter
 
+@_stage('get_res_qtr')
 def get_lit_res_la():
-    raw = get_data()
-    res = (raw[(raw.QuestionNumber == 'Q023') & (raw.ColText == 'Tonnage')]
-             .pivot_table(values='Data', index=['Authority','Period'],
-                          columns='RowText', aggfunc = lambda x: x).reset_index())
+    res = get_res_qtr()
     #Street Cleaning
     lit_str_qtr = res[['Authority','Period','Collected household waste : Street Cleaning']]
-    lit_str_la = lit_str_qtr.groupby('Authority').agg(np.sum).reset_index()
+    lit_str_la = _sum_la(lit_str_qtr, 'lit_str')
     
     #Flytipping
     lit_fly_qtr = res[['Authority','Period','Waste Arising from clearance of fly-tipped materials']]
-    lit_fly_la = lit_fly_qtr.groupby('Authority').agg(np.sum).reset_index()
+    lit_fly_la = _sum_la(lit_fly_qtr, 'lit_fly')
 
     #Final calculation for litter 
-    #(based on the WRAP estimation that 50% of Street Cleaning is Mechanical Sweeping)
-    merge = lit_str_la.merge(lit_fly_la, how='left',on='Authority')
+    merge = lit_str_la.merge(lit_fly_la, how='left',on=_la_keys())
     merge = merge.replace(np.NaN, 0)
-    merge['Litter'] = ((merge['Collected household waste : Street Cleaning']/2) 
-                       - merge['Waste Arising from clearance of fly-tipped materials'])
+    merge['Litter'] = _litter(merge, composition_rates)
     return merge
 
-def get_lit_res_drs():
-    lit_res_la = get_lit_res_la()
-    
-    #Initialise com_res_drs dataframe
-    lit_res_drs = pd.DataFrame(columns=['Authority','DRS Glass Bottles',
-                                    'DRS Plastic Bottles','DRS Ferrous Cans',
-                                    'DRS Aluminium Cans','DRS Beverage Cartons'])
-    lit_res_drs['Authority'] = lit_res_la['Authority']
+def _litter(lit_res_la, rates):
+    """
+    Input: Table from get_lit_res_la(), and composition rates (see _hhkerb_rec_drs_values())
+    Output: Litter for each local authority
+    """
+    #(based on the WRAP estimation that 50% of Street Cleaning is Mechanical Sweeping)
+    return (_column(lit_res_la, 'Collected household waste : Street Cleaning')*(1 - rates['lit_res_sweeping'])
+            - _column(lit_res_la, 'Waste Arising from clearance of fly-tipped materials'))
+
+def _lit_res_drs_values(lit_res_la, rates):
+    """
+    Input: Table from get_lit_res_la(), and composition rates (see _hhkerb_rec_drs_values())
+    Output: dict of DRS material -> tonnages for each local authority
+    """
+    litter = _litter(lit_res_la, rates)
     #Aplying ZWS rate: all packaging glass, plastic bottles, metal cans are DRS
     #Plastic bottle rates could be "PET & HDPE", or "PET, HDPE & other bottles"...
     #Which one to use? Currently using just "PET & HDPE"
-    lit_res_drs['DRS Glass Bottles'] = lit_res_la['Litter']*0.0688
-    lit_res_drs['DRS Plastic Bottles'] = lit_res_la['Litter']*0.0712
-    lit_res_drs['DRS Ferrous Cans'] = lit_res_la['Litter']*0.0183
-    lit_res_drs['DRS Aluminium Cans'] = lit_res_la['Litter']*0.0369
-    lit_res_drs['DRS Beverage Cartons'] = lit_res_la['Litter']*0.0045
+    return {'DRS Glass Bottles': litter*rates['lit_res_glass'],
+            'DRS Plastic Bottles': litter*rates['lit_res_plastics'],
+            'DRS Ferrous Cans': litter*rates['lit_res_ferrous'],
+            'DRS Aluminium Cans': litter*rates['lit_res_alum'],
+            'DRS Beverage Cartons': litter*rates['lit_res_cartons']}
+
+@_stage('get_lit_res_la')
+@_persistent
+def get_lit_res_drs():
+    lit_res_la = get_lit_res_la()
+    lit_res_drs = _drs_frame(lit_res_la,
+                             _lit_res_drs_values(lit_res_la, composition_rates))
     return lit_res_drs
 
 """
 Total weight modelled for each DRS material
 
 """
-
-def get_total_weight_drs_list(ave_pet_size = 0.75):
-    scot_wgt_list = [164.8, 38.6, 5.2, 8.9, 5, 222.5, 0]
-    scot_pop = 5347600.0
-    wales_pop = 3092000.0
-    uk_pop = 64596800.0
-    wales_scot_ratio = wales_pop / scot_pop
-    wales_uk_ratio = wales_pop / uk_pop
-    #(Categories: Glass, PET, HDPE, Ferrous, Aluminium, Carton)
-    ave_kg_list = [0.378, 0.033, 0.056, 0.035, 0.017, 0.021] #From Eunomia p.A13 & p.A 
+#Inputs of the placed-on-market model of get_market_weights()
+market_parameters = collections.OrderedDict([
+    #Glass placed on the market in Scotland (thousand tonnes, Eunomia)
+    ('scot_glass_weight', 164.8),
+    ('scot_pop', 5347600.0),
+    ('wales_pop', 3092000.0),
+    ('uk_pop', 64596800.0),
+    #Litres of soft drinks sold in the UK, and the share of them in PET bottles
+    ('uk_drinks_volume', 14800000000.0),
+    ('pet_share', 0.69),
+    #Average PET bottle size in litres (can change between 0.5 L to 1.5 L)
+    ('ave_pet_size', 0.5),
+    ('uk_hdpe_num', 4000000000.0),
+    ('uk_cans_num', 9800000000.0),
+    #Share of the cans that are ferrous (the rest are aluminium)
+    ('ferrous_share', 0.22),
+    ('uk_carton_weight', 60.0),
+    #Average weight of a container in kg (From Eunomia p.A13 & p.A)
+    ('pet_kg', 0.033),
+    ('hdpe_kg', 0.056),
+    ('ferrous_kg', 0.035),
+    ('alum_kg', 0.017),
+])
+
+def get_market_weights(**parameters):
+    """
+    Input: Values for any of market_parameters (the others keep theirs). Each can be a number
+    or an array, and the arrays are broadcast together.
+    Output: Array of the Wales weights in thousand tonnes placed on the market of each DRS material,
+    their total and 0 (as in get_total_weight_drs_list()), with shape (broadcast shape + (7,))
+    """
+    unknown = sorted(set(parameters) - set(market_parameters))
+    if unknown:
+        raise KeyError('Unknown market parameters: ' + ', '.join(unknown))
+    p = dict(market_parameters)
+    p.update(parameters)
+    p = dict((name, np.asarray(value, dtype=float)) for name, value in p.items())
+    wales_scot_ratio = p['wales_pop'] / p['scot_pop']
+    wales_uk_ratio = p['wales_pop'] / p['uk_pop']
     
     #Glass
-    wales_gla_wgt = scot_wgt_list[0] * wales_scot_ratio
+    wales_gla_wgt = p['scot_glass_weight'] * wales_scot_ratio
     
     #PET
-    uk_pet_vol = 14800000000 * 0.69
+    uk_pet_vol = p['uk_drinks_volume'] * p['pet_share']
     wales_pet_vol = uk_pet_vol * wales_uk_ratio
-    ave_pet_size = 0.5 #Can change between 0.5 L to 1.5 L
-    wales_pet_num = wales_pet_vol / ave_pet_size
-    wales_pet_wgt = wales_pet_num * ave_kg_list[1] / 1000000
+    wales_pet_num = wales_pet_vol / p['ave_pet_size']
+    wales_pet_wgt = wales_pet_num * p['pet_kg'] / 1000000
 
     #HDPE
-    uk_hdpe_num = 4000000000
-    wales_hdpe_num = uk_hdpe_num * wales_uk_ratio
-    wales_hdpe_wgt = wales_hdpe_num * ave_kg_list[2] / 1000000
+    wales_hdpe_num = p['uk_hdpe_num'] * wales_uk_ratio
+    wales_hdpe_wgt = wales_hdpe_num * p['hdpe_kg'] / 1000000
 
     #Plastic
     wales_pla_wgt = wales_pet_wgt + wales_hdpe_wgt
 
     #Cans
-    uk_cans_num = 9800000000
-    wales_cans_num = uk_cans_num * wales_uk_ratio
-    wales_fer_num = wales_cans_num * 0.22
-    wales_alum_num = wales_cans_num * 0.78
-    wales_fer_wgt = wales_fer_num * ave_kg_list[3] / 1000000
-    wales_alum_wgt = wales_alum_num * ave_kg_list[4] / 1000000
+    wales_cans_num = p['uk_cans_num'] * wales_uk_ratio
+    wales_fer_num = wales_cans_num * p['ferrous_share']
+    wales_alum_num = wales_cans_num * (1 - p['ferrous_share'])
+    wales_fer_wgt = wales_fer_num * p['ferrous_kg'] / 1000000
+    wales_alum_wgt = wales_alum_num * p['alum_kg'] / 1000000
 
     #Cartons
-    uk_car_wgt = 60
-    wales_car_wgt = uk_car_wgt * wales_uk_ratio
+    wales_car_wgt = p['uk_carton_weight'] * wales_uk_ratio
      
-    #Combined list
+    #Combined
     wales_total_wgt = wales_gla_wgt + wales_pla_wgt + wales_fer_wgt + wales_alum_wgt + wales_car_wgt
-    wales_wgt_list = [wales_gla_wgt, wales_pla_wgt, wales_fer_wgt, wales_alum_wgt, wales_car_wgt, 
-                      wales_total_wgt, 0]
-    return wales_wgt_list
+    weights = list(np.broadcast_arrays(wales_gla_wgt, wales_pla_wgt, wales_fer_wgt, wales_alum_wgt,
+                                       wales_car_wgt, wales_total_wgt))
+    return np.stack(weights + [np.zeros(weights[0].shape)], axis=-1)
+
+@_stage()
+def get_total_weight_drs_list(ave_pet_size = None):
+    #ave_pet_size is that of market_parameters unless given
+    parameters = {} if ave_pet_size is None else {'ave_pet_size': ave_pet_size}
+    return [float(weight) for weight in get_market_weights(**parameters)]
+
+def get_market_sweep(grid, **options):
+    """
+    Input: dict of market parameter name -> list of values,
+    e.g. {'ave_pet_size': np.arange(0.5, 1.55, 0.05)}, and the options of get_massflow_baseline()
+    Output: One dataframe with the mass flow baseline for every combination of the values
+    (the grid parameters in the first columns). The streams are computed once: only the total
+    weight and the remains in the environment change, and the weights of the whole grid are
+    one array calculation (see get_market_weights()).
+    """
+    if _run_state['quarterly']:
+        raise ValueError('get_market_sweep() is for one table, not one for each quarter')
+    names = list(grid)
+    values = [np.asarray(grid[name], dtype=float).reshape(-1) for name in names]
+    #Each parameter along its own axis, so that the weights broadcast to the whole grid
+    axes = dict((name, value.reshape([-1 if i == j else 1 for j in range(len(names))]))
+                for i, (name, value) in enumerate(zip(names, values)))
+    weights = get_market_weights(**axes).reshape(-1, len(drs_materials) + 2)
+    with pipeline_run():
+        totals = _stream_totals(_get_stream_values(**options), composition_rates)
+    tables = _baseline_values(np.repeat(totals, len(weights), axis=0), weights)
+    
+    points = list(itertools.product(*values))
+    sweep = pd.DataFrame(tables.reshape(-1, tables.shape[2]), columns=_baseline_frame(tables[0]).columns[1:])
+    sweep.insert(0, 'DRS Materials', (drs_materials + ['Total', 'Percent Contribution']) * len(tables))
+    for position, name in enumerate(names):
+        sweep.insert(position, name, np.repeat([point[position] for point in points], tables.shape[1]))
+    return sweep
 
 """
 Mass flow baseline master function
 
 """
+#Module settings the stages read, sent to worker processes: with spawn or forkserver
+#(rather than fork) they would otherwise start from the values at import
+_worker_setting_names = ['data_dir','raw_file','excluded_periods','raw_questions','use_sidecar',
+                         'result_cache_dir','result_cache_size','composition_rates','baseline_constants',
+                         'market_parameters','hhkerb_rec_rules','hhkerb_rec_overrides',
+                         'hhkerb_rec_excluded','hwrcs_rec_rules']
+
+def _worker_settings():
+    return dict((name, globals()[name]) for name in _worker_setting_names)
+
+def _apply_settings(settings):
+    globals().update(settings)
+
+def _run_stream_worker(args):
+    """
+    Input: (settings from _worker_settings(), period window, quarterly, list of (stage name, arguments)),
+    so that it can be sent to a worker process
+    Output: (list of the results of the stages, tables output on the way)
+    """
+    _apply_settings(args[0])
+    _run_state['window'], _run_state['quarterly'] = args[1], args[2]
+    records = []
+    with _redirect_output(lambda name, table, options: records.append((name, table, options))):
+        with pipeline_run():
+            results = [globals()[name](**kwargs) for name, kwargs in args[3]]
+    return results, records
+
+def _run_stream_groups(groups):
+    """
+    Input: List of groups of (stage name, arguments). The groups are independent of each other,
+    the stages within a group share intermediate tables.
+    Output: List of the results of the stages, in the order of the groups.
+    With max_workers, the groups not already computed in this run are computed at the same time
+    in that many worker processes. The raw data is loaded first, so that (with fork) the workers
+    share it instead of reading it again. The tables they output are handed to output_sink in the
+    order of the groups, and their results are kept for the rest of the run.
+    """
+    calls = [call for group in groups for call in group]
+    with pipeline_run():
+        memo = _run_state['memo']
+        keys = [(name, _call_key(_stages[name]['func'], (), kwargs), _run_state['window'],
+                 _run_state['quarterly']) for name, kwargs in calls]
+        pending = [group for group in groups
+                   if any(keys[calls.index(call)] not in memo for call in group)]
+        workers = min(max_workers or 1, len(pending))
+        #Worker processes of run_scenarios() cannot start processes of their own
+        if workers > 1 and not multiprocessing.current_process().daemon:
+            preload()
+            chunks = [(_worker_settings(), _run_state['window'], _run_state['quarterly'], group)
+                      for group in pending]
+            pool = multiprocessing.Pool(workers)
+            try:
+                done = pool.map(_run_stream_worker, chunks)
+            finally:
+                pool.close()
+                pool.join()
+            for group, (results, records) in zip(pending, done):
+                for name, table, options in records:
+                    output_sink(name, table, options)
+                for call, result in zip(group, results):
+                    memo[keys[calls.index(call)]] = result
+                    _run_state['last_run'].append(keys[calls.index(call)])
+        return [globals()[name](**kwargs) for name, kwargs in calls]
+
+def _get_stream_drs(reuse = 'No', reject = 'No', hhkerb_rec_method = 'WRAP',
+                    com_rec_method = 'Interpolation', dry_rec_method = 'Sum'):
+    """
+    Input: The options of get_massflow_baseline()
+    Output: List of (stream name, tonnages of DRS materials for each local authority),
+    for the seven streams in the order of stream_names
+    """
+    if com_rec_method == 'Interpolation':
+        com_rec_stage = 'get_com_rec_drs_int'
+    if com_rec_method == 'Eunomia':
+        com_rec_stage = 'get_com_rec_drs_zws'
+    #The streams are independent, except commercial recycling, which is interpolated
+    #from commercial residual, so the two are computed together (see _run_stream_groups())
+    groups = [[('get_hhkerb_rec_drs', {'reuse': reuse, 'method': hhkerb_rec_method,
+                                       'dry_rec': dry_rec_method})],
+              [('get_hhkerb_res_drs', {'reject': reject})],
+              [('get_hwrcs_rec_drs', {'reuse': reuse, 'dry_rec': dry_rec_method})],
+              [('get_hwrcs_res_drs', {'reject': reject})],
+              [(com_rec_stage, {}), ('get_com_res_drs', {})],
+              [('get_lit_res_drs', {})]]
+    return list(zip(stream_names, _run_stream_groups(groups)))
+
+@_stage('get_hhkerb_rec_drs', 'get_hhkerb_res_drs', 'get_hwrcs_rec_drs', 'get_hwrcs_res_drs',
+        'get_com_rec_drs_int', 'get_com_rec_drs_zws', 'get_com_res_drs', 'get_lit_res_drs')
+@_persistent
+def get_massflow_cube(reuse = 'No', reject = 'No', hhkerb_rec_method = 'WRAP',
+                      com_rec_method = 'Interpolation', dry_rec_method = 'Sum'):
+    """
+    Input: The options of get_massflow_baseline()
+    Output: A dataframe with the tonnages of DRS materials of every local authority in every stream,
+    indexed by (Authority, DRS Materials) for every local authority and every DRS material,
+    with one column for each stream in stream_names. Missing tonnages are 0, as in the baseline.
+    In quarterly(), indexed by (Authority, Period, DRS Materials).
+    
+    For the tonnages of one local authority or one material:
+    cube.loc['Cardiff Council'] or cube.xs('DRS Glass Bottles', level='DRS Materials')
+    get_cube_baseline() turns the cube (or some of its local authorities) into the baseline table.
+    """
+    stream_drs = _get_stream_drs(reuse=reuse, reject=reject, hhkerb_rec_method=hhkerb_rec_method,
+                                 com_rec_method=com_rec_method, dry_rec_method=dry_rec_method)
+    keys = _la_keys()
+    authorities = sorted(set().union(*[frame.set_index(keys).index for stream, frame in stream_drs]))
+    #values has shape (authorities, materials, streams)
+    values = np.dstack([frame.groupby(keys)[drs_materials].sum().reindex(authorities)
+                        .fillna(0).values.astype(float) for stream, frame in stream_drs])
+    if len(keys) == 1:
+        index = pd.MultiIndex.from_product([authorities, drs_materials], names=keys + ['DRS Materials'])
+    else:
+        index = pd.MultiIndex.from_tuples([authority + (material,) for authority in authorities
+                                           for material in drs_materials], names=keys + ['DRS Materials'])
+    cube = pd.DataFrame(values.reshape(-1, len(stream_names)), index=index, columns=stream_names)
+    
+    _output('massflow_cube', cube)
+    return cube
+
+def get_cube_baseline(cube, authorities = None):
+    """
+    Input: Cube from get_massflow_cube(), and optionally the local authorities to include
+    (by default all of them)
+    Output: A dataframe laid out like get_massflow_baseline(), with the tonnages of the cube summed
+    over the local authorities in thousand tonnes, the totals, the remains in the environment
+    and the percent contribution of each stream. For some of the local authorities only,
+    the total weight of DRS materials is their share of the population of Wales.
+    For a cube from quarterly(), one such table for each Period, one after the other,
+    with the Period in the first column. A quarter is given a quarter of the total weight.
+    """
+    values = cube.values.reshape(-1, len(drs_materials), len(stream_names))
+    rows = cube.index.droplevel('DRS Materials')[::len(drs_materials)]
+    names = rows.get_level_values('Authority')
+    share = 1.0
+    if authorities is not None:
+        missing = sorted(set(authorities) - set(names))
+        if missing:
+            raise KeyError('Authorities not in the cube: ' + ', '.join(missing))
+        pop = get_pop().groupby('Authority')['Population'].mean()
+        share = pop.reindex(list(authorities)).sum() / pop.sum()
+    selected = np.in1d(names, list(names if authorities is None else authorities))
+    if 'Period' not in cube.index.names:
+        totals = values[selected].sum(axis=0)[np.newaxis] / 1000
+        return _baseline_frame(_baseline_values(totals, get_total_weight_drs_list(), share)[0])
+    
+    #All the Periods are evaluated together, as the samples of _baseline_values()
+    period = rows.get_level_values('Period')
+    periods = [name for name in get_periods() if name in set(period)]
+    totals = np.array([values[selected & (period == name)].sum(axis=0) for name in periods]) / 1000
+    frames = []
+    for name, table in zip(periods, _baseline_values(totals, get_total_weight_drs_list(), share / 4.0)):
+        frame = _baseline_frame(table)
+        frame.insert(0, 'Period', name)
+        frames.append(frame)
+    return pd.concat(frames, ignore_index=True)
+
+@_stage('get_massflow_cube', 'get_total_weight_drs_list')
+@_persistent
 def get_massflow_baseline(reuse = 'No', reject = 'No', hhkerb_rec_method = 'WRAP', 
                           com_rec_method = 'Interpolation', dry_rec_method = 'Sum'):
     """
@@ -787,35 +2376,9 @@ def get_massflow_baseline(reuse = 'No', reject = 'No', hhkerb_rec_method = 'WRAP
     from sold containers, and the calculated remains of DRS materials in the environment
     """
     
-    if com_rec_method == 'Interpolation':
-        com_rec_drs = get_com_rec_drs_int()
-    if com_rec_method == 'Eunomia':
-        com_rec_drs = get_com_rec_drs_zws()
-
-    #For each stream, aggregate DRS tonnages from individual LAs to Wales-level 
-    hhkerb_rec_sum = (get_hhkerb_rec_drs(reuse=reuse, method=hhkerb_rec_method, dry_rec=dry_rec_method)
-                      .sum(axis=0, numeric_only=True).div(1000)
-                      .to_frame().reset_index().rename(columns={'RowText': 'DRS Materials',
-                                                     0: 'Household Kerbside Recycling'}))
-    hhkerb_res_sum = (get_hhkerb_res_drs(reject=reject).sum(axis=0, numeric_only=True)
-                      .div(1000).to_frame().reset_index()
-                      .rename(columns={'index': 'DRS Materials',0: 'Household Kerbside Residual'}))
-    hwrcs_rec_sum = (get_hwrcs_rec_drs(reuse=reuse, dry_rec=dry_rec_method)
-                     .sum(axis=0, numeric_only=True).div(1000).to_frame()
-                     .reset_index().rename(columns={'RowText': 'DRS Materials',0: 'HWRCs Recycling'}))
-    hwrcs_res_sum = (get_hwrcs_res_drs(reject=reject).sum(axis=0, numeric_only=True).div(1000)
-                     .to_frame().reset_index()
-                     .rename(columns={'index': 'DRS Materials',0: 'HWRCs Residual'}))
-    com_rec_sum = (com_rec_drs.sum(axis=0, numeric_only=True).div(1000).to_frame()
-                   .reset_index().rename(columns={'index': 'DRS Materials',0: 'Commercial Recycling'}))
-    com_res_sum = (get_com_res_drs().sum(axis=0, numeric_only=True).div(1000).to_frame()
-                   .reset_index().rename(columns={'index': 'DRS Materials',0: 'Commercial Residual'}))
-    lit_res_sum = (get_lit_res_drs().sum(axis=0, numeric_only=True).div(1000).to_frame()
-                   .reset_index().rename(columns={'index': 'DRS Materials',0: 'Litter Residual'}))
-    
-    #Initialise baseline dataframe
-    drs_list = ['DRS Glass Bottles','DRS Plastic Bottles','DRS Ferrous Cans','DRS Aluminium Cans',
-                'DRS Beverage Cartons','Total', 'Percent Contribution']
+    #Tonnages of DRS materials for each local authority and stream
+    cube = get_massflow_cube(reuse=reuse, reject=reject, hhkerb_rec_method=hhkerb_rec_method,
+                             com_rec_method=com_rec_method, dry_rec_method=dry_rec_method)
     
     #If using Scotland's number of containers from Eunonmia to estimate Wales data:
     #The tonnages from Scotland were calculated from Eunomia's number of containers and average weight
@@ -825,65 +2388,876 @@ def get_massflow_baseline(reuse = 'No', reject = 'No', hhkerb_rec_method = 'WRAP
     #                              'Total Weight in Thousand Tonnes':scot_wgt_list})
     #baseline['Total Weight in Thousand Tonnes'] = baseline['Total Weight in Thousand Tonnes']*.5782
     
-    #If using data gathered by Joan (sources specified in report), use get_total_weight_drs()
-    wales_wgt_list = get_total_weight_drs_list()
-    baseline = pd.DataFrame(data={'DRS Materials':drs_list,
-                                  'Total Weight in Thousand Tonnes': wales_wgt_list})
-    
-    #Merge in tonnage from every stream
-    baseline = baseline.merge(hhkerb_rec_sum, how = 'left', on='DRS Materials')
-    baseline = baseline.merge(hhkerb_res_sum, how = 'left', on='DRS Materials')
-    baseline = baseline.merge(hwrcs_rec_sum, how = 'left', on='DRS Materials')
-    baseline = baseline.merge(hwrcs_res_sum, how = 'left', on='DRS Materials')
-    baseline = baseline.merge(com_rec_sum, how = 'left', on='DRS Materials')
-    baseline = baseline.merge(com_res_sum, how = 'left', on='DRS Materials')
-    baseline = baseline.merge(lit_res_sum, how = 'left', on='DRS Materials')
-    
-    #Calculate the rest of the measures
-    baseline = baseline.replace(np.NaN, 0)
+    #If using data gathered by Joan (sources specified in report), get_cube_baseline() uses
+    #get_total_weight_drs_list(). It aggregates DRS tonnages from individual LAs to Wales-level
+    #and calculates the totals, our own estimate of "Remains in Environment" and the percent
+    #contribution of each stream.
     #Remains in environment could hopefully be calculated from all other measures, not a 1% estimation
-    #baseline['Remains in Environment (1%)'] = baseline['Total Weight in Thousand Tonnes']*.01
-    #Calculate the total from each stream
-    stream_list = ['Household Kerbside Recycling','Household Kerbside Residual',
-                   'HWRCs Recycling','HWRCs Residual',
-                   'Commercial Recycling','Commercial Residual',
-                   'Litter Residual']
-    for stream in stream_list:
-        baseline[stream] = np.where(baseline['DRS Materials']=='Total',
-                                    sum(baseline[stream]),baseline[stream])
-    #Calculate our own estimate of "Remains in Environment"
-    baseline['Remains in Environment (leftover)'] = (baseline['Total Weight in Thousand Tonnes'] 
-                                              - baseline['Household Kerbside Recycling']
-                                              - baseline['Household Kerbside Residual']
-                                              - baseline['HWRCs Recycling']
-                                              - baseline['HWRCs Residual']
-                                              - baseline['Commercial Recycling']
-                                              - baseline['Commercial Residual']
-                                              - baseline['Litter Residual'])
-    #Calculate percent contribution of each stream
-    stream_list.append('Remains in Environment (leftover)')
-    for stream in stream_list:
-        baseline[stream] = np.where(baseline['DRS Materials']=='Percent Contribution',
-                                    (baseline[baseline['DRS Materials']=='Total'][[stream]]
-                                    .div(1.402216, axis='index')[stream]),
-                                    baseline[stream])
-    baseline['Total Weight in Thousand Tonnes'] = np.where((baseline['DRS Materials']==
-                                                          'Percent Contribution'), 100, 
-                                                         baseline['Total Weight in Thousand Tonnes'])
-    
-    #Export to .csv
-    baseline.to_csv(op.join(data_dir, ('massflow_baseline_' 
-                                       + reuse + 'reuse_'
-                                       + reject + 'reject_'
-                                       + hhkerb_rec_method + '_'
-                                       + com_rec_method + '_'
-                                       + dt.datetime.today().strftime("%d%m")
-                                       + '.csv')), 
-                    encodings = 'utf-8')
+    baseline = get_cube_baseline(cube)
+    
+    _output('massflow_baseline', baseline)
     return baseline
 
-                            
+"""
+Uncertainty in the composition rates
+
+"""
 
+def _get_stream_values(reuse = 'No', reject = 'No', hhkerb_rec_method = 'WRAP',
+                       com_rec_method = 'Interpolation', dry_rec_method = 'Sum', source = None):
+    """
+    Input: The options of get_massflow_baseline(), and optionally a function of (name of the stage
+    that made a table, table) returning what the functions below use instead of the table
+    (see compile_baseline())
+    Output: List of (stream name, authorities, function), for the seven streams in the order of
+    stream_names. Each function takes composition rates and returns the stream's dict of
+    DRS material -> tonnages for each local authority (see _hhkerb_rec_drs_values()).
+    The tables behind the functions are computed (and the fallback rules compiled) here, once.
+    """
+    source = (lambda name, table: table) if source is None else source
+    reused = 'reu' if reuse == 'Yes' else ''
+    rejected = 'rej' if reject == 'Yes' else ''
+    if reuse == 'No':
+        hhkerb_rec_la = get_hhkerb_rec_la()
+        hwrcs_rec_la = get_hwrcs_rec_la()
+    if reuse == 'Yes':
+        hhkerb_rec_la = get_hhkerb_recreu_la()
+        hwrcs_rec_la = get_hwrcs_recreu_la()
+    if reject == 'No':
+        hhkerb_res_la = get_hhkerb_res_la()
+        hwrcs_res_la = get_hwrcs_res_la()
+    if reject == 'Yes':
+        hhkerb_res_la = get_hhkerb_resrej_la()
+        hwrcs_res_la = get_hwrcs_resrej_la()
+    hhkerb_rec = source('get_hhkerb_rec%s_la' % reused,
+                        _compile_hhkerb_rec(hhkerb_rec_la, dry_rec=dry_rec_method))
+    hwrcs_rec = source('get_hwrcs_rec%s_la' % reused, _compile_hwrcs_rec(hwrcs_rec_la, dry_rec=dry_rec_method))
+    hhkerb_res = source('get_hhkerb_res%s_la' % rejected, hhkerb_res_la)
+    hwrcs_res = source('get_hwrcs_res%s_la' % rejected, hwrcs_res_la)
+    com_res_int_la = get_com_res_int_la()
+    com_res_int = source('get_com_res_int_la', com_res_int_la)
+    lit_res_la = get_lit_res_la()
+    lit_res = source('get_lit_res_la', lit_res_la)
+    if com_rec_method == 'Interpolation':
+        com_rec_int = source('get_com_rec_int_la', get_com_rec_int_la())
+        com_rec_values = lambda rates: _com_rec_drs_int_values(com_rec_int, com_res_int, rates)
+    if com_rec_method == 'Eunomia':
+        com_rec_values = lambda rates: _com_rec_drs_zws_values(com_res_int, rates)
     
-                                                     
+    return [('Household Kerbside Recycling', hhkerb_rec_la['Authority'].values,
+             lambda rates: _hhkerb_rec_drs_values(hhkerb_rec, rates, method=hhkerb_rec_method)),
+            ('Household Kerbside Residual', hhkerb_res_la['Authority'].values,
+             lambda rates: _hhkerb_res_drs_values(hhkerb_res, rates)),
+            ('HWRCs Recycling', hwrcs_rec_la['Authority'].values,
+             lambda rates: _evaluate_rules(hwrcs_rec, rates)),
+            ('HWRCs Residual', hwrcs_res_la['Authority'].values,
+             lambda rates: _hwrcs_res_drs_values(hwrcs_res, rates)),
+            ('Commercial Recycling', com_res_int_la['Authority'].values, com_rec_values),
+            ('Commercial Residual', com_res_int_la['Authority'].values,
+             lambda rates: _com_res_drs_values(com_res_int, rates)),
+            ('Litter Residual', lit_res_la['Authority'].values,
+             lambda rates: _lit_res_drs_values(lit_res, rates))]
+
+def _sample_rates(distributions, samples, seed = None):
+    """
+    Input: dict of composition rate name -> distribution, given either as the name of a
+    numpy.random distribution followed by its parameters, e.g. ('uniform', 0.6, 0.7),
+    ('normal', 0.8915, 0.02) or ('triangular', 0.4, 0.5, 0.6), or as a function of
+    (numpy RandomState, number of samples)
+    Output: Composition rates, where each rate in distributions is an array of shape (samples, 1)
+    """
+    unknown = sorted(set(distributions) - set(composition_rates))
+    if unknown:
+        raise KeyError('Unknown composition rates: ' + ', '.join(unknown))
+    random_state = np.random.RandomState(seed)
+    rates = dict(composition_rates)
+    #Draw in the order of composition_rates, so that a seed always gives the same samples
+    for name in composition_rates:
+        if name not in distributions:
+            continue
+        distribution = distributions[name]
+        if callable(distribution):
+            draws = distribution(random_state, samples)
+        else:
+            draws = getattr(random_state, distribution[0])(*distribution[1:], size=samples)
+        rates[name] = np.asarray(draws, dtype=float).reshape(samples, 1)
+    return rates
+
+def _stream_totals(stream_values, rates, samples = 1):
+    """
+    Input: List from _get_stream_values(), and composition rates (see _sample_rates())
+    Output: Wales totals in thousand tonnes, with shape (samples, materials, streams)
+    """
+    totals = np.zeros((samples, len(drs_materials), len(stream_values)))
+    for j, (stream, authorities, stream_func) in enumerate(stream_values):
+        values = stream_func(rates)
+        for i, material in enumerate(drs_materials):
+            #As in get_massflow_baseline(), missing tonnages are left out of the sums
+            totals[:, i, j] = np.nansum(np.atleast_2d(values[material]), axis=-1) / 1000
+    return totals
+
+def _baseline_values(totals, total_weight, share = 1.0):
+    """
+    Input: Stream totals from _stream_totals(), the list from get_total_weight_drs_list()
+    (or an array with one for each sample, see get_market_weights()), and the share of it to use
+    (see get_cube_baseline())
+    Output: The numbers of the get_massflow_baseline() table for every sample, with shape
+    (samples, rows, columns). Rows are drs_materials, 'Total' and 'Percent Contribution';
+    columns are the total weight, stream_names and the remains in the environment.
+    """
+    weight = np.asarray(total_weight, dtype=float)[..., :len(drs_materials) + 1] * share
+    #One list for every sample, or one for each
+    weight = np.broadcast_to(weight, (len(totals), len(drs_materials) + 1))[:, :, np.newaxis]
+    streams = np.concatenate([totals, totals.sum(axis=1)[:, np.newaxis, :]], axis=1)
+    leftover = weight - streams.sum(axis=2)[:, :, np.newaxis]
+    table = np.concatenate([weight, streams, leftover], axis=2)
+    #Percent contribution, as calculated in get_massflow_baseline()
+    percent = table[:, -1:, :] / (baseline_constants['percent_divisor'] * share)
+    percent[:, :, 0] = 100
+    return np.concatenate([table, percent], axis=1)
+
+def _baseline_frame(values):
+    """
+    Input: One (rows, columns) table from _baseline_values()
+    Output: The table as a dataframe laid out like get_massflow_baseline()
+    """
+    baseline = pd.DataFrame(values, columns=['Total Weight in Thousand Tonnes'] + stream_names
+                                            + ['Remains in Environment (leftover)'])
+    baseline.insert(0, 'DRS Materials', drs_materials + ['Total', 'Percent Contribution'])
+    return baseline
 
+def get_massflow_uncertainty(distributions, samples = 10000, percentiles = (5, 50, 95), seed = None,
+                             **options):
+    """
+    Input: dict of composition rate name (see composition_rates) -> distribution (see _sample_rates()),
+    e.g. {'hhkerb_rec_reject': ('uniform', 0.85, 0.93), 'lit_res_sweeping': ('triangular', 0.4, 0.5, 0.6)},
+    the number of samples, and the options of get_massflow_baseline().
+    Rates not in distributions keep their value in composition_rates.
+    Output: The mass flow baseline table at each percentile of the samples, one after the other,
+    with the percentile in the first column.
+    All samples are evaluated together as array calculations, not one baseline run each.
+    """
+    if _run_state['quarterly']:
+        raise ValueError('get_massflow_uncertainty() is for one table, not one for each quarter')
+    with pipeline_run():
+        stream_values = _get_stream_values(**options)
+        total_weight = get_total_weight_drs_list()
+    rates = _sample_rates(distributions, samples, seed=seed)
+    values = _baseline_values(_stream_totals(stream_values, rates, samples), total_weight)
+    bands = np.percentile(values, list(percentiles), axis=0)
+    
+    frames = []
+    for percentile, band in zip(percentiles, bands):
+        frame = _baseline_frame(band)
+        frame.insert(0, 'Percentile', percentile)
+        frames.append(frame)
+    return pd.concat(frames, ignore_index=True)
+
+"""
+Linear operator
+
+"""
+#For a given set of data and options, the baseline table is a sum of terms, each the product of
+#a few composition rates (or 1/(1 - rate), for commercial recycling) and one tonnage of one local
+#authority from the tables behind the streams. compile_baseline() runs the stream functions once
+#on _Linear values, which keep those terms, and turns them into a sparse matrix from
+#(product of rates x tonnage) to the cells of the table. Re-evaluating the baseline with other
+#rates or corrected tonnages is then one sparse matrix-vector product.
+
+class _Linear(object):
+    """
+    Tonnages of a stream for each local authority as a sum of terms.
+    terms maps (monomial, source) to the coefficient of each local authority, where monomial is a
+    tuple of composition rate names (or _Linear.__truediv__() atoms) multiplied together, and source
+    is the (stage, column) of the tonnage multiplied with them, or None for a constant.
+    value is the tonnages at the compiled rates and tonnages, to decide what _fill_missing() picks.
+    """
+    #numpy arrays leave the arithmetic with a _Linear to it
+    __array_ufunc__ = None
+    __array_priority__ = 1000
+    
+    def __init__(self, terms, value):
+        self.terms = terms
+        self.value = value
+    
+    def __add__(self, other):
+        other = _linear(other)
+        terms = dict(self.terms)
+        for key, coefficient in other.terms.items():
+            terms[key] = terms[key] + coefficient if key in terms else coefficient
+        return _Linear(terms, self.value + other.value)
+    
+    __radd__ = __add__
+    
+    def __neg__(self):
+        return _Linear(dict((key, -coefficient) for key, coefficient in self.terms.items()), -self.value)
+    
+    def __sub__(self, other):
+        return self + -_linear(other)
+    
+    def __rsub__(self, other):
+        return _linear(other) + -self
+    
+    def __mul__(self, other):
+        other = _linear(other)
+        terms = {}
+        for (monomial, source), coefficient in self.terms.items():
+            for (other_monomial, other_source), other_coefficient in other.terms.items():
+                if source is not None and other_source is not None:
+                    raise ValueError('Tonnages multiplied together cannot be compiled')
+                key = (tuple(sorted(monomial + other_monomial, key=repr)),
+                       source if other_source is None else other_source)
+                product = coefficient * other_coefficient
+                terms[key] = terms[key] + product if key in terms else product
+        return _Linear(terms, self.value * other.value)
+    
+    __rmul__ = __mul__
+    
+    def __truediv__(self, other):
+        if not isinstance(other, _Linear):
+            return self * (1.0 / np.asarray(other, dtype=float))
+        #Dividing by rates, e.g. (1 - rate), multiplies with a new atom for 1/(1 - rate)
+        if any(source is not None or np.ndim(coefficient) > 0
+               for (monomial, source), coefficient in other.terms.items()):
+            raise ValueError('Only divisions by composition rates can be compiled')
+        atom = ('1/', tuple(sorted(other.terms.items(), key=repr)))
+        return self * _Linear({((atom,), None): 1.0}, 1.0 / other.value)
+    
+    def __rtruediv__(self, other):
+        return _linear(other) / self
+    
+    __div__ = __truediv__
+    __rdiv__ = __rtruediv__
+
+def _linear(values):
+    #Numbers and arrays as constant terms
+    return values if isinstance(values, _Linear) else _Linear({((), None): values}, values)
+
+def _value(values):
+    return values.value if isinstance(values, _Linear) else values
+
+def _select(condition, values, other):
+    """
+    Input: Boolean array over the local authorities, and two sets of tonnages (_Linear or numbers)
+    Output: _Linear with the terms of values where condition is True, and of other elsewhere
+    """
+    values, other = _linear(values), _linear(other)
+    terms = dict((key, np.where(condition, values.terms.get(key, 0.0), other.terms.get(key, 0.0)))
+                 for key in set(values.terms) | set(other.terms))
+    return _Linear(terms, np.where(condition, values.value, other.value))
+
+def _evaluate_rules_linear(compiled, rates):
+    """
+    Input: Rules from _compile_rules() with _Linear source columns, and composition rates
+    Output: dict of DRS material -> _Linear tonnages, as _evaluate_rules() computes them
+    """
+    values = {}
+    for material, (terms, mask) in compiled['materials'].items():
+        flows = 0.0
+        for j, rule in enumerate(terms):
+            for col, rule_names in rule:
+                coefficient = functools.reduce(lambda x, name: x * rates[name], rule_names, 1.0)
+                flows = flows + compiled['source'][col] * coefficient * mask[:, j]
+        values[material] = _select(mask.any(axis=1), flows, np.nan)
+    return values
+
+def compile_baseline(**options):
+    """
+    Input: The options of get_massflow_baseline()
+    Output: dict with the baseline compiled for evaluate_compiled_baseline(): 'operator', a sparse
+    matrix (a numpy array without scipy) from the terms to the cells of the table, 'constant', the
+    cells that are neither (the total weight), 'sources', a dataframe with the Stage, Column,
+    Authority and Tonnage of every tonnage the terms use, and how to compute the terms from them.
+    The choices the pipeline makes from the data stay as compiled: the fallback rule each LA uses,
+    the missing tonnages filled in or left out, and the commercial estimates from median rates.
+    """
+    if _run_state['quarterly']:
+        raise ValueError('compile_baseline() is for one table, not one for each quarter')
+    sources, offsets = [], {}
+    def source(name, table):
+        #Every numeric column of the table as one tonnage of each local authority
+        if isinstance(table, dict):
+            authority, columns, values = table['authority'], table['columns'], table['source']
+        else:
+            authority = table['Authority'].values
+            columns = [col for col in table.columns if col not in _la_keys()]
+            values = table[columns].values.astype(float)
+        symbolic = {}
+        for j, col in enumerate(columns):
+            offsets[(name, col)] = len(sources)
+            sources.extend((name, col, la, value) for la, value in zip(authority, values[:, j]))
+            symbolic[col] = _Linear({((), (name, col)): np.ones(len(authority))}, values[:, j])
+        return dict(table, source=symbolic) if isinstance(table, dict) else symbolic
+    
+    with pipeline_run():
+        stream_values = _get_stream_values(source=source, **options)
+        total_weight = get_total_weight_drs_list()
+    rates = dict((name, _Linear({((name,), None): 1.0}, value)) for name, value in composition_rates.items())
+    
+    #Terms are (monomial, source tonnage), and entries (stream total, term, coefficient)
+    monomials, terms, entries = collections.OrderedDict(), collections.OrderedDict(), []
+    for j, (stream, authorities, stream_func) in enumerate(stream_values):
+        values = stream_func(rates)
+        for i, material in enumerate(drs_materials):
+            value = _linear(values[material])
+            #As in get_massflow_baseline(), missing tonnages are left out of the sums
+            kept = np.isfinite(value.value) & np.ones(len(authorities), dtype=bool)
+            for monomial, table in sorted(value.terms, key=repr):
+                coefficient = value.terms[(monomial, table)] * np.ones(len(authorities))
+                for a in np.flatnonzero(kept & (coefficient != 0)):
+                    index = -1 if table is None else offsets[table] + a
+                    key = (monomials.setdefault(monomial, len(monomials)), index)
+                    entries.append((i * len(stream_values) + j, terms.setdefault(key, len(terms)),
+                                    coefficient[a] / 1000))
+    
+    #The table is affine in the stream totals: read the matrix off _baseline_values()
+    size = len(drs_materials) * len(stream_values)
+    unit = np.concatenate([np.zeros((1, size)), np.eye(size)]).reshape(-1, len(drs_materials),
+                                                                        len(stream_values))
+    tables = _baseline_values(unit, total_weight)
+    layout = (tables[1:] - tables[0]).reshape(size, -1).T
+    rows, columns, coefficients = [np.array(values) for values in zip(*entries)]
+    if sparse is not None:
+        totals = sparse.csr_matrix((coefficients, (rows, columns)), shape=(size, len(terms)))
+        operator = sparse.csr_matrix(layout).dot(totals).tocsr()
+    else:
+        totals = np.zeros((size, len(terms)))
+        np.add.at(totals, (rows, columns), coefficients)
+        operator = layout.dot(totals)
+    
+    atoms = list(composition_rates) + sorted(set(atom for monomial in monomials for atom in monomial
+                                                 if atom not in composition_rates), key=repr)
+    degree = max([len(monomial) for monomial in monomials] + [1])
+    #Atom indices of each monomial, padded with the index of 1
+    factors = np.full((len(monomials), degree), len(atoms), dtype=int)
+    for m, monomial in enumerate(monomials):
+        factors[m, :len(monomial)] = [atoms.index(atom) for atom in monomial]
+    keys = np.array(list(terms), dtype=int).reshape(-1, 2)
+    sources = pd.DataFrame(sources, columns=['Stage','Column','Authority','Tonnage'])
+    return {'operator': operator, 'constant': tables[0].ravel(), 'shape': tables.shape[1:],
+            'atoms': atoms, 'factors': factors, 'term_monomials': keys[:, 0], 'term_sources': keys[:, 1],
+            'sources': sources, 'tonnages': sources['Tonnage'].values, 'options': options,
+            'constants': dict(baseline_constants),
+            'source_index': dict((key, n) for n, key in
+                                 enumerate(zip(sources['Stage'], sources['Column'], sources['Authority'])))}
+
+def _atom_value(atom, rates):
+    if not isinstance(atom, tuple):
+        return rates[atom]
+    #1/(sum of coefficient x product of rates)
+    return 1.0 / sum(coefficient * functools.reduce(lambda x, name: x * rates[name], monomial, 1.0)
+                     for (monomial, source), coefficient in atom[1])
+
+def evaluate_compiled_baseline(compiled, rates = None, tonnages = None, frame = True):
+    """
+    Input: Baseline from compile_baseline(), dict of composition rate (or baseline_constants)
+    name -> value for those that differ from the module's (a value can be a 1-D array of samples),
+    and the tonnages that differ from the compiled ones, as dict of (Stage, Column, Authority)
+    -> tonnage (see compiled['sources']) or an array of every tonnage
+    Output: The mass flow baseline table as a dataframe laid out like get_massflow_baseline(),
+    or with frame=False its numbers (rows, columns), or (samples, rows, columns) with samples
+    """
+    values = dict(composition_rates)
+    if rates:
+        unknown = sorted(set(rates) - set(composition_rates) - set(baseline_constants))
+        if unknown:
+            raise KeyError('Unknown composition rates or constants: ' + ', '.join(unknown))
+        values.update(rates)
+    tonnage = compiled['tonnages']
+    if isinstance(tonnages, dict):
+        tonnage = tonnage.copy()
+        for key, value in tonnages.items():
+            if key not in compiled['source_index']:
+                raise KeyError('Unknown tonnage: ' + repr(key))
+            tonnage[compiled['source_index'][key]] = value
+    elif tonnages is not None:
+        tonnage = np.asarray(tonnages, dtype=float)
+    
+    atoms = [_atom_value(atom, values) for atom in compiled['atoms']]
+    samples = max([np.size(value) for value in (rates or {}).values()] + [1])
+    #One row for each atom, and a last row of 1
+    atom_values = np.ones((len(atoms) + 1, samples))
+    if samples == 1:
+        atom_values[:-1, 0] = atoms
+    else:
+        for k, value in enumerate(atoms):
+            atom_values[k] = np.ravel(value)
+    #Terms (terms x samples), then one sparse product for the cells (cells x samples)
+    products = atom_values[compiled['factors']].prod(axis=1)[compiled['term_monomials']]
+    products *= np.append(tonnage, 1.0)[compiled['term_sources']][:, np.newaxis]
+    cells = compiled['operator'].dot(products) + compiled['constant'][:, np.newaxis]
+    
+    table = np.asarray(cells).T.reshape((-1,) + tuple(compiled['shape']))
+    if rates and 'percent_divisor' in rates:
+        #The Percent Contribution row was compiled with the divisor of that time
+        table[:, -1, 1:] *= (compiled['constants']['percent_divisor']
+                             / np.ravel(rates['percent_divisor']))[:, np.newaxis]
+    if samples > 1:
+        return table
+    return _baseline_frame(table[0]) if frame else table[0]
+
+"""
+Sensitivity analysis
+
+"""
+#Which of the registered parameters (composition_rates and baseline_constants) drive a column of
+#the baseline table. Every evaluation goes through compile_baseline(), in batches of samples.
+
+#Samples evaluated together by evaluate_compiled_baseline()
+sensitivity_batch = 8192
+
+def _parameter_bounds(spread, bounds):
+    """
+    Input: Relative spread around each parameter's value, and dict of parameter name -> (low, high)
+    for the parameters with other bounds
+    Output: OrderedDict of every registered parameter -> (low, high). Composition rates are shares,
+    so they stay at most 1.
+    """
+    bounds = dict(bounds or {})
+    parameters = collections.OrderedDict(composition_rates)
+    parameters.update(baseline_constants)
+    unknown = sorted(set(bounds) - set(parameters))
+    if unknown:
+        raise KeyError('Unknown composition rates or constants: ' + ', '.join(unknown))
+    ranges = collections.OrderedDict()
+    for name, value in parameters.items():
+        low, high = bounds.get(name, (value * (1 - spread), value * (1 + spread)))
+        ranges[name] = (low, min(high, 1.0) if name in composition_rates and name not in bounds else high)
+    return ranges
+
+def _evaluate_parameters(compiled, ranges, points, column):
+    """
+    Input: Baseline from compile_baseline(), parameter bounds from _parameter_bounds(),
+    points in the unit hypercube (points x parameters), and a column of the baseline table
+    Output: The column at each point (points x rows of the table)
+    """
+    columns = ['Total Weight in Thousand Tonnes'] + stream_names + ['Remains in Environment (leftover)']
+    low = np.array([bound[0] for bound in ranges.values()])
+    high = np.array([bound[1] for bound in ranges.values()])
+    values = low + points * (high - low)
+    outputs = []
+    for start in range(0, len(values), sensitivity_batch):
+        batch = values[start:start + sensitivity_batch]
+        #A batch of one would be read as one evaluation without samples
+        batch = np.concatenate([batch, batch[:1]]) if len(batch) == 1 else batch
+        table = evaluate_compiled_baseline(compiled, dict(zip(ranges, batch.T)), frame=False)
+        outputs.append(table[:len(values[start:start + sensitivity_batch]), :, columns.index(column)])
+    return np.concatenate(outputs)
+
+def _morris_indices(compiled, ranges, column, trajectories, levels, random_state):
+    """
+    Output: Morris elementary effects over the unit hypercube: mu, mu* (mean of the absolute
+    effects) and sigma, each with shape (parameters, rows of the table)
+    """
+    k = len(ranges)
+    delta = levels / (2.0 * (levels - 1))
+    #Each trajectory starts on the grid of levels, and moves each parameter by delta once,
+    #in a random order and direction
+    starts = random_state.randint(0, levels // 2, size=(trajectories, k)) / float(levels - 1)
+    signs = random_state.choice([-1.0, 1.0], size=(trajectories, k))
+    starts = np.where(signs > 0, starts, starts + delta)
+    orders = np.array([random_state.permutation(k) for t in range(trajectories)])
+    points = np.repeat(starts[:, np.newaxis, :], k + 1, axis=1)
+    for step in range(k):
+        moved = orders[:, step]
+        points[np.arange(trajectories), step + 1:, moved] += (signs[np.arange(trajectories), moved]
+                                                              * delta)[:, np.newaxis]
+    outputs = _evaluate_parameters(compiled, ranges, points.reshape(-1, k), column)
+    outputs = outputs.reshape(trajectories, k + 1, -1)
+    
+    #Elementary effects (trajectories x parameters x rows)
+    effects = np.zeros((trajectories, k, outputs.shape[2]))
+    for step in range(k):
+        moved = orders[:, step]
+        effects[np.arange(trajectories), moved] = ((outputs[:, step + 1] - outputs[:, step])
+                                                   * (signs[np.arange(trajectories), moved] / delta)[:, np.newaxis])
+    return (effects.mean(axis=0), np.abs(effects).mean(axis=0),
+            effects.std(axis=0, ddof=1) if trajectories > 1 else np.zeros(effects.shape[1:]))
+
+def _sobol_indices(compiled, ranges, column, samples, random_state):
+    """
+    Output: First order (Saltelli 2010) and total (Jansen) Sobol indices, each with shape
+    (parameters, rows of the table)
+    """
+    k = len(ranges)
+    a, b = random_state.rand(samples, k), random_state.rand(samples, k)
+    #A, B, then A with column i from B for each parameter i
+    mixed = np.repeat(a[np.newaxis], k, axis=0)
+    mixed[np.arange(k), :, np.arange(k)] = b[:, np.arange(k)].T
+    outputs = _evaluate_parameters(compiled, ranges, np.concatenate([a, b, mixed.reshape(-1, k)]), column)
+    #Centred, as the estimators are noisier the further the mean is from 0
+    outputs = outputs - outputs[:2 * samples].mean(axis=0)
+    f_a, f_b = outputs[:samples], outputs[samples:2 * samples]
+    f_mixed = outputs[2 * samples:].reshape(k, samples, -1)
+    
+    variance = np.concatenate([f_a, f_b]).var(axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        first = (f_b[np.newaxis] * (f_mixed - f_a[np.newaxis])).mean(axis=1) / variance
+        total = 0.5 * ((f_a[np.newaxis] - f_mixed) ** 2).mean(axis=1) / variance
+    return first, total
+
+def get_massflow_sensitivity(method = 'Sobol', column = 'Remains in Environment (leftover)', spread = 0.1,
+                             bounds = None, samples = 2048, trajectories = 100, levels = 4, seed = None,
+                             **options):
+    """
+    Input: 'Sobol' or 'Morris', a column of the baseline table, the spread of every registered
+    parameter around its value (0.1 for +-10%), dict of parameter name -> (low, high) for other
+    bounds, the number of base samples (Sobol, evaluating samples x (parameters + 2) points) or
+    of trajectories on a grid of levels (Morris, trajectories x (parameters + 1) points),
+    a random seed, and the options of get_massflow_baseline()
+    Output: A dataframe with one row for each row of the table (drs_materials, 'Total' and
+    'Percent Contribution') and parameter, with its bounds and either the first order (S1) and
+    total (ST) Sobol indices, or the Morris mu, mu* and sigma (over the unit range of each parameter).
+    Parameters the options do not use (e.g. Eunomia rates with the WRAP method) come out as 0.
+    """
+    ranges = _parameter_bounds(spread, bounds)
+    compiled = compile_baseline(**options)
+    random_state = np.random.RandomState(seed)
+    if method == 'Sobol':
+        indices = _sobol_indices(compiled, ranges, column, samples, random_state)
+        names = ['S1', 'ST']
+    elif method == 'Morris':
+        indices = _morris_indices(compiled, ranges, column, trajectories, levels, random_state)
+        names = ['mu', 'mu*', 'sigma']
+    else:
+        raise ValueError("method must be 'Sobol' or 'Morris'")
+    
+    rows = drs_materials + ['Total', 'Percent Contribution']
+    index = pd.MultiIndex.from_product([rows, list(ranges)], names=['DRS Materials', 'Parameter'])
+    sensitivity = pd.DataFrame(collections.OrderedDict((name, values.T.reshape(-1))
+                                                       for name, values in zip(names, indices)), index=index)
+    sensitivity.insert(0, 'Low', [ranges[name][0] for row in rows for name in ranges])
+    sensitivity.insert(1, 'High', [ranges[name][1] for row in rows for name in ranges])
+    return sensitivity.reset_index()
+
+"""
+Calibration of the composition rates
+
+"""
+#The remains in the environment are what the streams leave of the total weight, so
+#they can come out implausible. calibrate_rates() adjusts chosen composition rates within
+#bounds to match targets for it (e.g. from a litter survey), by bounded least squares on the
+#compiled baseline, with the derivatives of the table computed from its terms.
+
+def _atom_derivative(atom, name, rates):
+    #Derivative of a rate, or of 1/(sum of products of rates), with respect to one rate
+    if not isinstance(atom, tuple):
+        return 1.0 if atom == name else 0.0
+    derivative = 0.0
+    for (monomial, source), coefficient in atom[1]:
+        if name in monomial:
+            position = monomial.index(name)
+            others = monomial[:position] + monomial[position + 1:]
+            derivative += (coefficient * monomial.count(name)
+                           * functools.reduce(lambda x, other: x * rates[other], others, 1.0))
+    return -derivative * _atom_value(atom, rates) ** 2
+
+def get_compiled_jacobian(compiled, names, rates = None):
+    """
+    Input: Baseline from compile_baseline(), names of composition rates, and dict of composition
+    rate name -> value for the rates that differ from composition_rates
+    Output: The derivative of every number of the baseline table with respect to each of the rates,
+    with shape (rows, columns, rates)
+    """
+    values = dict(composition_rates)
+    values.update(rates or {})
+    unknown = sorted(set(names) - set(composition_rates))
+    if unknown:
+        raise KeyError('Unknown composition rates: ' + ', '.join(unknown))
+    atoms = compiled['atoms']
+    atom_values = np.append([_atom_value(atom, values) for atom in atoms], 1.0)
+    #Derivatives of each atom (and of the 1 padding the monomials)
+    derivatives = np.zeros((len(atoms) + 1, len(names)))
+    for a, atom in enumerate(atoms):
+        for j, name in enumerate(names):
+            derivatives[a, j] = _atom_derivative(atom, name, values)
+    
+    #Product rule over the factors of each monomial (monomials x rates)
+    factors = compiled['factors']
+    gradient = np.zeros((len(factors), len(names)))
+    for d in range(factors.shape[1]):
+        others = factors.copy()
+        others[:, d] = len(atoms)
+        gradient += atom_values[others].prod(axis=1)[:, np.newaxis] * derivatives[factors[:, d]]
+    terms = (gradient[compiled['term_monomials']]
+             * np.append(compiled['tonnages'], 1.0)[compiled['term_sources']][:, np.newaxis])
+    return np.asarray(compiled['operator'].dot(terms)).reshape(tuple(compiled['shape']) + (len(names),))
+
+def calibrate_rates(targets, bounds, column = 'Remains in Environment (leftover)', weights = None,
+                    prior = 1e-3, tolerance = 1e-3, **options):
+    """
+    Input: dict of row of the baseline table (a DRS material, 'Total' or 'Percent Contribution')
+    -> target for the column in that row, dict of composition rate name -> (low, high) for the
+    rates to adjust (the others keep their value), the column, dict of row -> weight of its target
+    (1 by default), the weight of keeping each rate near its value in composition_rates
+    (relative to its bounds, so that of the rates matching the targets the least changed are chosen),
+    the largest miss of a target that counts as met, and the options of get_massflow_baseline()
+    Output: (OrderedDict of each adjusted rate -> calibrated value, the baseline table with them,
+    dict of the fit: the 'status', 'message' and 'cost' of scipy.optimize.least_squares(), 'targets',
+    a dataframe with the Target, Before, After and Residual of each target row, and 'at_bound',
+    the rates left at one of their bounds). If a target is missed by more than tolerance with rates
+    at their bounds, a warning says so: the target cannot be met within the bounds.
+    """
+    if optimize is None:
+        raise ImportError('scipy is required to calibrate composition rates')
+    unknown = sorted(set(bounds) - set(composition_rates))
+    if unknown:
+        raise KeyError('Unknown composition rates: ' + ', '.join(unknown))
+    rows = drs_materials + ['Total', 'Percent Contribution']
+    unknown = sorted(set(targets) - set(rows))
+    if unknown:
+        raise KeyError('Unknown rows of the baseline table: ' + ', '.join(unknown))
+    columns = ['Total Weight in Thousand Tonnes'] + stream_names + ['Remains in Environment (leftover)']
+    
+    compiled = compile_baseline(**options)
+    names = list(bounds)
+    low = np.array([bounds[name][0] for name in names], dtype=float)
+    high = np.array([bounds[name][1] for name in names], dtype=float)
+    initial = np.array([composition_rates[name] for name in names], dtype=float)
+    target_rows = [rows.index(row) for row in targets]
+    target_values = np.array(list(targets.values()), dtype=float)
+    scale = np.sqrt([(weights or {}).get(row, 1.0) for row in targets])
+    spread = np.where(high > low, high - low, 1.0)
+    
+    def residuals(x):
+        table = evaluate_compiled_baseline(compiled, dict(zip(names, x)), frame=False)
+        return np.concatenate([scale * (table[target_rows, columns.index(column)] - target_values),
+                               np.sqrt(prior) * (x - initial) / spread])
+    def jacobian(x):
+        derivatives = get_compiled_jacobian(compiled, names, dict(zip(names, x)))
+        return np.concatenate([scale[:, np.newaxis] * derivatives[target_rows, columns.index(column)],
+                               np.diag(np.sqrt(prior) / spread)])
+    
+    result = optimize.least_squares(residuals, np.clip(initial, low, high), jac=jacobian,
+                                    bounds=(low, high))
+    calibrated = collections.OrderedDict(zip(names, result.x))
+    baseline = evaluate_compiled_baseline(compiled, calibrated)
+    
+    before = evaluate_compiled_baseline(compiled, frame=False)[target_rows, columns.index(column)]
+    after = baseline[column].values[target_rows].astype(float)
+    fit_targets = pd.DataFrame({'Target': target_values, 'Before': before, 'After': after,
+                                'Residual': after - target_values}, index=list(targets),
+                               columns=['Target','Before','After','Residual'])
+    fit_targets.index.name = 'DRS Materials'
+    at_bound = [name for name, active in zip(names, result.active_mask) if active != 0]
+    if at_bound and (np.abs(fit_targets['Residual']) > tolerance).any():
+        warnings.warn('Targets missed by up to %.4g with %s at their bounds: the targets cannot be met '
+                      'within the bounds' % (np.abs(fit_targets['Residual']).max(), ', '.join(at_bound)))
+    fit = {'status': result.status, 'message': result.message, 'cost': result.cost,
+           'targets': fit_targets.reset_index(), 'at_bound': at_bound}
+    return calibrated, baseline, fit
+
+"""
+Scenario sweep
+
+"""
+#All the options of get_massflow_baseline()
+scenario_options = {'reuse': ['No','Yes'],
+                    'reject': ['No','Yes'],
+                    'hhkerb_rec_method': ['WRAP','Eunomia'],
+                    'com_rec_method': ['Interpolation','Eunomia'],
+                    'dry_rec_method': ['Sum','Comingled']}
+
+def _expand_grid(grid):
+    """
+    Input: A dict of option name -> list of values (every combination is used),
+    or a list of dicts of options (each dict is one scenario)
+    Output: List of scenarios, each a dict with every option of get_massflow_baseline()
+    """
+    if isinstance(grid, dict):
+        names = sorted(grid)
+        grid = [dict(zip(names, values))
+                for values in itertools.product(*[grid[name] for name in names])]
+    baseline_func = _stages['get_massflow_baseline']['func']
+    return [inspect.getcallargs(baseline_func, **scenario) for scenario in grid]
+
+def _run_scenario_list(args):
+    """
+    Input: (settings from _worker_settings(), list of (scenario number, scenario)),
+    so that it can be sent to a worker process
+    Output: List of (scenario number, baseline) for each scenario
+    """
+    _apply_settings(args[0])
+    results = []
+    #One run for all the scenarios, so that stages they have in common are computed once
+    with pipeline_run():
+        for number, scenario in args[1]:
+            results.append((number, get_massflow_baseline(**scenario)))
+    return results
+
+def _run_scenario_worker(args):
+    """
+    Input: See _run_scenario_list()
+    Output: (results of _run_scenario_list(), tables output on the way), so that the tables
+    can be handed to the output_sink of the main process
+    """
+    records = []
+    with _redirect_output(lambda name, table, options: records.append((name, table, options))):
+        results = _run_scenario_list(args)
+    return results, records
+
+def run_scenarios(grid=None, processes=None):
+    """
+    Input: grid of options for get_massflow_baseline(), either a dict of option name -> list of values,
+    e.g. {'reuse': ['No','Yes'], 'hhkerb_rec_method': ['WRAP','Eunomia']}, or a list of dicts.
+    By default, every combination in scenario_options.
+    If processes is given, the scenarios are split between that many worker processes.
+    Starting them and sending the tables back costs more than the 22 local authorities of the
+    spreadsheet take to compute (3 processes are slower than none for the default grid), so this
+    only pays off for large sweeps or much larger data.
+    Output: One dataframe with the mass flow baseline of every scenario, with a 'Scenario' number
+    and the options of each scenario in the first columns
+    """
+    scenarios = list(enumerate(_expand_grid(scenario_options if grid is None else grid)))
+    if processes is None or processes < 2:
+        preload()
+        results = _run_scenario_list((_worker_settings(), scenarios))
+    else:
+        chunks = [(_worker_settings(), scenarios[i::processes]) for i in range(processes)]
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = []
+            for chunk, records in pool.map(_run_scenario_worker, chunks):
+                results.extend(chunk)
+                for name, table, options in records:
+                    output_sink(name, table, options)
+        finally:
+            pool.close()
+            pool.join()
+    results.sort(key=lambda result: result[0])
+    
+    option_names = ['reuse','reject','hhkerb_rec_method','com_rec_method','dry_rec_method']
+    frames = []
+    for number, baseline in results:
+        scenario = scenarios[number][1]
+        for position, name in enumerate(['Scenario'] + option_names):
+            baseline.insert(position, name, number if name == 'Scenario' else scenario[name])
+        frames.append(baseline)
+    return pd.concat(frames, ignore_index=True)
+
+"""
+Rolling windows
+
+"""
+
+def get_rolling_baselines(quarters = 4, **options):
+    """
+    Input: Number of consecutive quarters in a window (4 for a year), and options of
+    get_massflow_baseline()
+    Output: One dataframe with the mass flow baseline of every window of that many quarters
+    in the raw data (see get_periods()), with the first and last Period of each window in the
+    first columns. The quarterly tables are summed once for all the windows (see _sum_la()).
+    """
+    periods = get_periods()
+    windows = [periods[i:i + quarters] for i in range(0, len(periods) - quarters + 1)]
+    frames = []
+    with pipeline_run():
+        for window in windows:
+            with period_window(window):
+                baseline = get_massflow_baseline(**options)
+            baseline.insert(0, 'First Period', window[0])
+            baseline.insert(1, 'Last Period', window[-1])
+            frames.append(baseline)
+    return pd.concat(frames, ignore_index=True)
+
+"""
+DRS return rate scenarios
+
+"""
+#With a DRS returning a share r of the containers of a material placed on the market,
+#r of that material's total weight goes to the DRS, and every other destination
+#(each stream and the remains in the environment) keeps (1 - r) of its baseline tonnage.
+#For a local authority, only the tonnage in its streams can be diverted: the remains in the
+#environment are not split by LA. So over the LAs, 'Diverted to DRS' sums to the national
+#'DRS Returns' less r times the remains in the environment.
+
+def _return_rate_array(return_rates):
+    """
+    Input: DRS return rates between 0 and 1. A scalar or 1-D array gives the same rate to every
+    material; a 2-D array has one row per scenario and one column per material in drs_materials
+    Output: 2-D array of rates, scenarios x materials
+    """
+    rates = np.array(return_rates, dtype=float)
+    if rates.ndim < 2:
+        rates = np.repeat(rates.reshape(-1, 1), len(drs_materials), axis=1)
+    if rates.ndim != 2 or rates.shape[1] != len(drs_materials):
+        raise ValueError('return_rates must have one column for each of ' + ', '.join(drs_materials))
+    if (rates < 0).any() or (rates > 1).any():
+        raise ValueError('return_rates must be between 0 and 1')
+    return rates
+
+def get_drs_return_flows(return_rates, baseline = None, **options):
+    """
+    Input: DRS return rates (see _return_rate_array()), e.g. np.arange(.5, .955, .005),
+    and the mass flow baseline (by default get_massflow_baseline(**options))
+    Output: A dataframe with the mass flow of every DRS material for every scenario
+    in thousand tonnes, including the tonnage returned through the DRS (r times the total weight,
+    so also from the remains in the environment, see get_drs_return_flows_la()).
+    For a baseline from quarterly(), the flows of each Period, with the Period after the Scenario.
+    All scenarios (and Periods) are evaluated together as one array calculation.
+    """
+    rates = _return_rate_array(return_rates)
+    if baseline is None:
+        baseline = get_massflow_baseline(**options)
+    #One table, or one for each Period (see get_cube_baseline())
+    if 'Period' in baseline.columns:
+        periods = list(pd.unique(baseline['Period']))
+        tables = [baseline[baseline['Period'] == name] for name in periods]
+    else:
+        periods, tables = None, [baseline]
+    tables = [table.set_index('DRS Materials').loc[drs_materials] for table in tables]
+    destinations = stream_names + ['Remains in Environment (leftover)']
+    
+    #total has shape (tables, materials), flows has shape (tables, materials, destinations)
+    total = np.array([table['Total Weight in Thousand Tonnes'].values for table in tables], dtype=float)
+    flows = np.array([table[destinations].values for table in tables], dtype=float)
+    #Broadcast to scenarios x tables x materials x destinations
+    drs_flows = flows[np.newaxis] * (1 - rates)[:, np.newaxis, :, np.newaxis]
+    returned = rates[:, np.newaxis, :] * total[np.newaxis]
+    values = np.concatenate([np.repeat(total[np.newaxis, :, :, np.newaxis], len(rates), axis=0),
+                             returned[:, :, :, np.newaxis], drs_flows], axis=3)
+    #Add the 'Total' row of every scenario
+    values = np.concatenate([values, values.sum(axis=2)[:, :, np.newaxis, :]], axis=2)
+    rate_values = np.concatenate([np.repeat(rates[:, np.newaxis, :], len(tables), axis=1),
+                                  (returned.sum(axis=2) / total.sum(axis=1))[:, :, np.newaxis]], axis=2)
+    
+    if periods is None:
+        index = pd.MultiIndex.from_product([range(len(rates)), drs_materials + ['Total']],
+                                           names=['Scenario','DRS Materials'])
+    else:
+        index = pd.MultiIndex.from_product([range(len(rates)), periods, drs_materials + ['Total']],
+                                           names=['Scenario','Period','DRS Materials'])
+    columns = ['Total Weight in Thousand Tonnes','DRS Returns'] + destinations
+    drs_flows = pd.DataFrame(values.reshape(-1, len(columns)), index=index, columns=columns)
+    drs_flows.insert(0, 'Return Rate', rate_values.reshape(-1))
+    return drs_flows.reset_index()
+
+def get_drs_return_flows_la(return_rates, **options):
+    """
+    Input: DRS return rates (see _return_rate_array()), and the options of get_massflow_baseline()
+    Output: A dataframe with the tonnages of DRS materials left in each stream of each local authority
+    (and Period, in quarterly()) for every scenario, and the tonnage diverted from that local
+    authority's streams to the DRS (r times its stream tonnage, see the comment above: the remains
+    in the environment that get_drs_return_flows() also counts as returned are not split by LA)
+    """
+    rates = _return_rate_array(return_rates)
+    cube = get_massflow_cube(**options)
+    #One unit for each Authority, or (Authority, Period) in quarterly()
+    keys = [name for name in cube.index.names if name != 'DRS Materials']
+    units = [unit if isinstance(unit, tuple) else (unit,)
+             for unit in cube.index.droplevel('DRS Materials')[::len(drs_materials)]]
+    #cube has shape (units, materials, streams)
+    cube = cube.values.reshape(len(units), len(drs_materials), len(stream_names))
+    #Broadcast to scenarios x units x materials x streams
+    kept = cube[np.newaxis] * (1 - rates)[:, np.newaxis, :, np.newaxis]
+    diverted = cube.sum(axis=2)[np.newaxis] * rates[:, np.newaxis, :]
+    values = np.concatenate([kept, diverted[:, :, :, np.newaxis]], axis=3)
+    
+    index = pd.MultiIndex.from_tuples([(scenario,) + unit + (material,) for scenario in range(len(rates))
+                                       for unit in units for material in drs_materials],
+                                      names=['Scenario'] + keys + ['DRS Materials'])
+    drs_flows_la = pd.DataFrame(values.reshape(-1, len(stream_names) + 1), index=index,
+                                columns=stream_names + ['Diverted to DRS'])
+    drs_flows_la.insert(0, 'Return Rate',
+                        np.repeat(rates[:, np.newaxis, :], len(units), axis=1).reshape(-1))
+    return drs_flows_la.reset_index()
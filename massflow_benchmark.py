@@ -0,0 +1,315 @@
+""" Mass Flow Baseline benchmarks
+
+This module times the loading of the raw data, each stage and the whole
+mass flow baseline of massflow_baseline on synthetic WasteDataFlow exports,
+so that changes to the module can be compared at sizes the real
+spreadsheet (22 local authorities) cannot show.
+
+The synthetic exports have the columns of the NotQ100 sheet, and the
+questions the stages read (Q001, Q010, Q011, Q016, Q017 and Q023) with
+the RowText and ColText they look for. The number of authorities,
+quarters and recycling materials can be chosen.
+"""
+
+""" How to use this module:
+
+import massflow_benchmark
+results = massflow_benchmark.run_benchmarks()
+massflow_benchmark.save_benchmarks(results)
+
+Each call of save_benchmarks() adds the results, with the current git commit,
+to data/benchmarks.csv. To compare two commits (the latest results of each):
+
+massflow_benchmark.compare_benchmarks('3a338d0', '12734ea')
+
+Or from a shell, to run the default scales and save the results:
+
+python massflow_benchmark.py
+"""
+
+import numpy as np
+import pandas as pd
+import os.path as op
+import datetime as dt
+import time
+import sys
+import collections
+import shutil
+import subprocess
+import tempfile
+import massflow_baseline
+
+"""
+Synthetic WasteDataFlow exports
+
+"""
+#The first authorities have the names of the real ones (the fallback rules name some of them)
+authority_names = ['Blaenau Gwent CBC','Bridgend CBC','Caerphilly CBC','Cardiff Council',
+                   'Carmarthenshire CC','Ceredigion CC','City  and County of Swansea ','Conwy CBC',
+                   'Denbighshire CC','Flintshire CC','Gwynedd Council','Isle of Anglesey CC',
+                   'Merthyr Tydfil CBC','Monmouthshire CC','Neath Port Talbot CBC','Newport City Council',
+                   'Pembrokeshire CC','Powys County Council','Rhondda Cynon Taf CBC','Torfaen CBC',
+                   'Vale of Glamorgan Council','Wrexham CBC']
+
+#Recycling materials the stages select or drop by name, so every export has them
+stage_materials = ['Green garden waste only','Mixed garden and food waste','Waste food only',
+                   'Mixed glass','Brown glass','Clear glass','Green glass','Mixed Plastic Bottles',
+                   'Plastics','Steel cans','Aluminium cans','Mixed cans',
+                   'Composite food and beverage cartons','Co mingled materials']
+
+residual_types = ['Collected household waste : Regular Collection',
+                  'Civic amenity sites waste : Household',
+                  'Collected non-household waste : Commercial & Industrial',
+                  'Collected household waste : Street Cleaning',
+                  'Waste Arising from clearance of fly-tipped materials',
+                  'Collected household waste : Bulky Waste']
+
+export_columns = ['Authority','Period','QuestionNumber','QuText','RowText','ColText','MaterialGroup',
+                  'Data','CollateText','RowOrder','ColOrder','RowIdent','ColIdent','CollateID',
+                  'columngroup']
+
+def _period_names(quarters):
+    #WasteDataFlow quarters from April 2014, e.g. 'Apr 14 - Jun 14'
+    months = ['Jan','Feb','Mar','Apr','May','Jun','Jul','Aug','Sep','Oct','Nov','Dec']
+    names = []
+    for quarter in range(quarters):
+        start = 3 + 3 * quarter
+        year = 14 + start // 12
+        names.append('%s %02d - %s %02d' % (months[start % 12], year, months[start % 12 + 2], year))
+    return names
+
+def _block(authorities, periods, question, coltext, rowtexts, values, reported):
+    """
+    Input: Names of the authorities, periods and rows, the question and column of the block,
+    values (authorities x periods x rows) and whether each was reported (same shape)
+    Output: Dataframe with the reported cells of the block, one row each
+    """
+    a, p, r = np.nonzero(reported)
+    block = pd.DataFrame({'Authority': np.asarray(authorities, dtype=object)[a],
+                          'Period': np.asarray(periods, dtype=object)[p],
+                          'RowText': np.asarray(rowtexts, dtype=object)[r],
+                          'Data': np.round(values[a, p, r], 2)})
+    block['QuestionNumber'] = question
+    block['QuText'] = 'Synthetic ' + question
+    block['ColText'] = coltext
+    block['MaterialGroup'] = 'Synthetic'
+    return block
+
+def synthetic_raw(authorities = 22, quarters = 4, materials = 16, density = 0.7, seed = 0):
+    """
+    Input: Number of local authorities, of quarters (from April 2014), and of recycling materials
+    (at least the len(stage_materials) materials the stages use), the share of recycling
+    materials each authority reports in a quarter, and a random seed
+    Output: Raw data shaped like the NotQ100 sheet of a WasteDataFlow export, with every column
+    """
+    if materials < len(stage_materials):
+        raise ValueError('materials must be at least ' + str(len(stage_materials)))
+    rng = np.random.RandomState(seed)
+    names = authority_names[:authorities] + ['Synthetic Authority %03d' % number
+                                             for number in range(len(authority_names), authorities)]
+    periods = _period_names(quarters)
+    material_names = stage_materials + ['Other material %02d' % number
+                                        for number in range(materials - len(stage_materials))]
+    size = (authorities, quarters)
+    population = rng.randint(20000, 400000, size=authorities).astype(float)
+    blocks = []
+
+    #Population and households
+    pop = np.repeat(population[:, np.newaxis], quarters, axis=1)[:, :, np.newaxis]
+    blocks.append(_block(names, periods, 'Q001', 'Value', ['Population of Authority','Households'],
+                         np.concatenate([pop, pop / 2.3], axis=2), np.ones(size + (2,), dtype=bool)))
+
+    #Recycling tonnages, proportional to population
+    scale = (population / 1000.0)[:, np.newaxis, np.newaxis]
+    for question in ['Q010','Q011','Q016','Q017']:
+        reported = rng.rand(authorities, 1, materials) < density
+        #The first authority reports everything, so that every material is a column
+        reported[0] = True
+        reported = np.repeat(reported, quarters, axis=1)
+        values = rng.gamma(2.0, 2.0, size=size + (materials,)) * scale
+        blocks.append(_block(names, periods, question, 'Tonnage collected for recycling',
+                             material_names, values, reported))
+
+    #Reuse and rejected recycling, for a few materials
+    for question, coltext in [('Q010','Tonnage Collected for Reuse'),
+                              ('Q016','Tonnage collected for reuse'),
+                              ('Q017','Tonnage collected for reuse'),
+                              ('Q010','Tonnage collected for recycling but actually rejected/disposed'),
+                              ('Q016','Tonnage collected for recycling but actually rejected / disposed')]:
+        values = rng.gamma(1.0, 0.5, size=size + (3,)) * scale * (rng.rand(authorities, 1, 1) < 0.6)
+        blocks.append(_block(names, periods, question, coltext, material_names[3:6], values,
+                             np.ones(size + (3,), dtype=bool)))
+
+    #Residual tonnages
+    values = rng.gamma(4.0, 10.0, size=size + (len(residual_types),)) * scale
+    reported = np.ones(size + (len(residual_types),), dtype=bool)
+    #Some authorities have no commercial residual, as in the real data
+    reported[:, :, 2] = np.repeat(rng.rand(authorities, 1) < 0.85, quarters, axis=1)
+    blocks.append(_block(names, periods, 'Q023', 'Tonnage', residual_types, values, reported))
+
+    raw = pd.concat(blocks, ignore_index=True)
+    raw = raw.iloc[rng.permutation(len(raw))].reset_index(drop=True)
+    for number, col in enumerate(['CollateText','RowOrder','ColOrder','RowIdent','ColIdent',
+                                  'CollateID','columngroup']):
+        raw[col] = 'Synthetic' if col == 'CollateText' else number
+    return raw[export_columns]
+
+def write_synthetic_export(path, **options):
+    """
+    Input: Path of a .csv file, and the options of synthetic_raw()
+    Output: Number of rows written. The file is laid out like a .csv export of the NotQ100 sheet,
+    with a title line before the column names, so that massflow_baseline.read_export() reads it
+    """
+    raw = synthetic_raw(**options)
+    with open(path, 'w') as f:
+        f.write('NotQ100\n')
+        raw.to_csv(f, index=False)
+    return len(raw)
+
+"""
+Benchmarks
+
+"""
+#(authorities, quarters, materials) of each scale run by run_benchmarks()
+default_scales = [(22, 4, 16), (100, 4, 16), (400, 4, 16), (400, 8, 24)]
+
+benchmark_file = op.join('data', 'benchmarks.csv')
+
+def _cpu_time():
+    return time.process_time() if hasattr(time, 'process_time') else time.clock()
+
+def _measure(func, memory = False):
+    """
+    Input: Function without arguments, and whether to trace its memory (needs tracemalloc)
+    Output: (wall time, CPU time, peak memory in bytes allocated by it or NaN)
+    """
+    tracemalloc = massflow_baseline.tracemalloc
+    memory = memory and tracemalloc is not None and not tracemalloc.is_tracing()
+    if memory:
+        tracemalloc.start()
+    wall, cpu = time.time(), _cpu_time()
+    try:
+        func()
+        wall, cpu = time.time() - wall, _cpu_time() - cpu
+        peak = tracemalloc.get_traced_memory()[1] if memory else np.nan
+    finally:
+        if memory:
+            tracemalloc.stop()
+    return wall, cpu, peak
+
+def _run_scale(directory, authorities, quarters, materials, repeat):
+    """
+    Input: Directory for the synthetic export, one scale, and the number of repeats
+    Output: List of (benchmark, wall time, CPU time, peak memory) at that scale, keeping
+    the fastest of the repeats, and the number of rows of the export
+    """
+    path = op.join(directory, 'synthetic_%d_%d_%d.csv' % (authorities, quarters, materials))
+    rows = write_synthetic_export(path, authorities=authorities, quarters=quarters, materials=materials)
+    massflow_baseline.data_dir, massflow_baseline.raw_file = directory, op.basename(path)
+
+    timings = collections.OrderedDict()
+    def keep(name, wall, cpu, peak):
+        #The fastest time of the repeats, and the memory of the first
+        if name in timings:
+            wall, cpu, peak = min(wall, timings[name][0]), min(cpu, timings[name][1]), timings[name][2]
+        timings[name] = (wall, cpu, peak)
+    for number in range(repeat):
+        #Memory is only traced in the first repeat, as tracing slows everything down
+        memory = number == 0
+        keep('read_export', *_measure(lambda: massflow_baseline.read_export(path), memory))
+        massflow_baseline.clear_cache()
+        keep('get_data', *_measure(massflow_baseline.get_data, memory))
+        #First baseline after loading, including the pivots, and each stage of it
+        #(without the stages it called)
+        with massflow_baseline.profile_stages(memory=memory) as trace:
+            massflow_baseline.get_massflow_baseline()
+        for record in trace:
+            if record['Depth'] == 0:
+                keep('get_massflow_baseline', record['Wall Time'], record['CPU Time'], record['Peak Memory'])
+            elif record['Cache'] == 'computed':
+                keep(record['Stage'], record['Self Wall Time'], record['Self CPU Time'],
+                     record['Peak Memory'])
+        #Later baselines, with the pivots already cached
+        keep('get_massflow_baseline (repeat)', *_measure(massflow_baseline.get_massflow_baseline, memory))
+    return [(name,) + timings[name] for name in timings], rows
+
+def _commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=op.dirname(op.abspath(massflow_baseline.__file__)),
+                                       stderr=subprocess.STDOUT).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+def run_benchmarks(scales = None, repeat = 3):
+    """
+    Input: List of (authorities, quarters, materials), by default default_scales,
+    and the number of times each benchmark is repeated
+    Output: A dataframe with one row for each benchmark at each scale: the wall and CPU time
+    in seconds (the fastest of the repeats), the peak memory allocated in MB, and the git commit
+    and code hash of massflow_baseline. The benchmarks are reading the export, loading it with
+    get_data(), the first get_massflow_baseline() (and the time of each stage in it, without the
+    stages it called), and a repeated get_massflow_baseline().
+    The settings of massflow_baseline are put back afterwards.
+    """
+    scales = default_scales if scales is None else scales
+    settings = dict((name, getattr(massflow_baseline, name))
+                    for name in ['data_dir','raw_file','use_sidecar','result_cache_dir','max_workers'])
+    #Only the computation is timed: no sidecar, result cache or worker processes
+    massflow_baseline.use_sidecar = False
+    massflow_baseline.result_cache_dir = None
+    massflow_baseline.max_workers = None
+    directory = tempfile.mkdtemp()
+    results = []
+    try:
+        for authorities, quarters, materials in scales:
+            timings, rows = _run_scale(directory, authorities, quarters, materials, repeat)
+            for name, wall, cpu, peak in timings:
+                results.append((authorities, quarters, materials, rows, name, wall, cpu, peak / (1024 * 1024)))
+    finally:
+        for name, value in settings.items():
+            setattr(massflow_baseline, name, value)
+        massflow_baseline.clear_cache()
+        shutil.rmtree(directory, ignore_errors=True)
+
+    results = pd.DataFrame(results, columns=['Authorities','Quarters','Materials','Rows','Benchmark',
+                                             'Wall Time','CPU Time','Peak Memory (MB)'])
+    results.insert(0, 'Date', dt.datetime.today().strftime('%Y-%m-%d %H:%M'))
+    results.insert(1, 'Commit', _commit())
+    results.insert(2, 'Code', massflow_baseline._code_digest()[:12])
+    return results
+
+def save_benchmarks(results, path = None):
+    """
+    Input: Results from run_benchmarks(), and the CSV file to add them to (benchmark_file by default)
+    Output: None
+    """
+    path = benchmark_file if path is None else path
+    results.to_csv(path, mode='a', header=not op.exists(path), index=False)
+
+def compare_benchmarks(before, after, path = None):
+    """
+    Input: Two commits (or code hashes) in the benchmark file, and its path (benchmark_file by default)
+    Output: A dataframe with the wall time and peak memory of every benchmark run for both,
+    from the latest results of each, and the ratio after / before (above 1 is slower or larger)
+    """
+    results = pd.read_csv(benchmark_file if path is None else path, dtype={'Commit': str, 'Code': str})
+    keys = ['Authorities','Quarters','Materials','Benchmark']
+    frames = []
+    for label in [before, after]:
+        runs = results[(results['Commit'] == label) | (results['Code'] == label)]
+        if not len(runs):
+            raise KeyError('No benchmark results for ' + label)
+        #The latest results of the commit
+        runs = runs[runs['Date'] == runs['Date'].max()]
+        frames.append(runs.set_index(keys)[['Wall Time','Peak Memory (MB)']])
+    comparison = frames[0].join(frames[1], how='inner', lsuffix=' Before', rsuffix=' After')
+    comparison['Wall Time Ratio'] = comparison['Wall Time After'] / comparison['Wall Time Before']
+    comparison['Peak Memory Ratio'] = (comparison['Peak Memory (MB) After']
+                                       / comparison['Peak Memory (MB) Before'])
+    return comparison.reset_index()
+
+if __name__ == '__main__':
+    results = run_benchmarks()
+    save_benchmarks(results, sys.argv[1] if len(sys.argv) > 1 else None)
+    print(results.to_string())